@@ -0,0 +1,96 @@
+"""
+Non-blocking execution of the notebook callbacks
+
+Loads run on a background thread while the kernel keeps serving widget
+events; the result is drawn back on the kernel event loop. A new request on
+a channel cancels the one in flight, so only the latest click is drawn.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class Cancelled(Exception):
+    """
+    Raised inside a load when a newer request replaced it
+    """
+    pass
+
+class Token(object):
+    """
+    Cancellation flag handed to a load, which calls check() between steps
+    """
+
+    def __init__(self):
+
+        self.cancelled = False
+
+    def check(self):
+
+        if self.cancelled:
+            raise Cancelled()
+
+class LatestRunner(object):
+    """
+    Run one background load per channel, keeping only the latest request
+
+    Parameters
+    ----------
+    workers: int
+        Background threads (the NetCDF reads are serialized anyway)
+    """
+
+    def __init__(self, workers=1):
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._current = {}
+
+    def submit(self, channel, load, render, progress=None, on_error=None):
+        """
+        Run load(token) in the background, then render(result) on the event loop
+
+        progress() is called right away (e.g. to show a message), on_error(exc)
+        if the load fails.
+        """
+        self.cancel(channel)
+
+        token = Token()
+        if progress is not None:
+            progress()
+
+        task = asyncio.ensure_future(self._run(token, load, render, on_error))
+        self._current[channel] = (token, task)
+
+        return task
+
+    async def _run(self, token, load, render, on_error):
+
+        loop = asyncio.get_event_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, load, token)
+        except Cancelled:
+            return
+        except Exception as exc:
+            if on_error is not None and not token.cancelled:
+                on_error(exc)
+                return
+            raise
+
+        if not token.cancelled:
+            render(result)
+
+    def cancel(self, channel=None):
+        """
+        Cancel the request in flight on a channel (or on every channel)
+        """
+        for c in list(self._current):
+            if channel is None or c == channel:
+                token, task = self._current.pop(c)
+                token.cancelled = True
+                task.cancel()
+
+#Runner used by the notebook
+runner = LatestRunner()
+
+#Runner of the long tasks (scene copies, catalogue indexing, job
+#submissions), on their own threads so the plots and tiles do not wait
+#behind them
+background = LatestRunner(workers=4)
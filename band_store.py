@@ -0,0 +1,211 @@
+"""
+Per-scene band cache
+
+Keeps the NetCDF handles and the decoded band arrays of the scenes being
+browsed, so switching between bands, indices and RGB views of one scene
+does not go back to the (Onedata) disk.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from netCDF4 import Dataset
+
+import instrumentation
+import local_scenes
+
+
+def array_nbytes(arr):
+    """
+    Memory used by an array, counting the mask of masked arrays
+    """
+    nbytes = arr.nbytes
+    mask = np.ma.getmask(arr)
+    if mask is not np.ma.nomask:
+        nbytes += mask.nbytes
+    return nbytes
+
+
+def window_slices(window, step=1):
+    """
+    Slices selecting a pixel window, decimated by step
+    """
+    if window is None:
+        return (slice(None, None, step), slice(None, None, step))
+
+    r0, r1, c0, c1 = window
+    return (slice(r0, r1, step), slice(c0, c1, step))
+
+
+def read_decimated(var, window=None, step=1):
+    """
+    Read a window of a 2D variable keeping every step-th row and column
+
+    Decimated reads go strip by strip along the chunk rows, so only one
+    strip of the full resolution raster is in memory at a time.
+    """
+    if step == 1:
+        return var[window_slices(window)]
+
+    nrows, ncols = var.shape
+    r0, r1, c0, c1 = window if window is not None else (0, nrows, 0, ncols)
+
+    chunking = var.chunking()
+    strip = chunking[0] if isinstance(chunking, list) else 256
+    strip = max(step, strip - strip % step)
+
+    strips = []
+    for start in range(r0, r1, strip):
+        block = var[start:min(start + strip, r1), c0:c1]
+        strips.append(block[::step, ::step])
+
+    return np.ma.concatenate(strips, axis=0)
+
+
+class BandStore(object):
+    """
+    Keyed store of open datasets and band arrays with LRU eviction
+
+    Parameters
+    ----------
+    max_bytes: int
+        Memory budget for the cached band arrays
+    max_datasets: int
+        Maximum number of NetCDF handles kept open at the same time
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3, max_datasets=8):
+
+        self.max_bytes = max_bytes
+        self.max_datasets = max_datasets
+        self.nbytes = 0
+        self._datasets = OrderedDict()
+        self._arrays = OrderedDict()
+        self._lock = threading.RLock()
+
+    def dataset(self, path):
+        """
+        Return the open dataset of a scene, opening it only once
+        """
+        with self._lock:
+            if path in self._datasets:
+                self._datasets.move_to_end(path)
+                return self._datasets[path]
+
+            dataset = Dataset(path, 'r', format='NETCDF4_CLASSIC')
+            self._datasets[path] = dataset
+
+            while len(self._datasets) > self.max_datasets:
+                old_path, old_dataset = self._datasets.popitem(last=False)
+                old_dataset.close()
+
+            return dataset
+
+    def lookup(self, key):
+        """
+        Return a cached array (or None) and mark it as recently used
+        """
+        with self._lock:
+            if key not in self._arrays:
+                return None
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+
+    def put(self, key, arr):
+        """
+        Cache an array under a key, evicting the least recently used ones
+        """
+        # cached arrays are shared between callers
+        arr.flags.writeable = False
+        nbytes = array_nbytes(arr)
+
+        with self._lock:
+            if key in self._arrays:
+                self.nbytes -= array_nbytes(self._arrays.pop(key))
+
+            if nbytes > self.max_bytes:
+                return arr
+
+            self._arrays[key] = arr
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                old_key, old_arr = self._arrays.popitem(last=False)
+                self.nbytes -= array_nbytes(old_arr)
+
+        return arr
+
+    def get(self, path, band, window=None, step=1):
+        """
+        Return the array of a band, reading it from disk only once
+
+        Parameters
+        ----------
+        window: tuple or None
+            Pixel window (row_start, row_stop, col_start, col_stop) to read,
+            None for the whole raster
+        step: int
+            Decimation factor applied to rows and columns
+
+        Raises KeyError if the scene has no such variable.
+        """
+        key = (path, band, window, step)
+        arr = self.lookup(key)
+        if arr is not None:
+            return arr
+
+        # a window of a band already in memory is just a view
+        full = self.lookup((path, band, None, 1))
+        if full is not None:
+            return full[window_slices(window, step)]
+
+        return self.put(key, self.read(path, band, window, step))
+
+    def read(self, path, band, window=None, step=1):
+        """
+        Read a band (window) without caching it, from the local copy of the
+        scene if there is one (see local_scenes), else from the file
+        """
+        with instrumentation.span('read_band', band=band, step=step) as sp:
+            arr = local_scenes.read(path, band, window, step)
+            if arr is not None:
+                if sp is not None:
+                    sp['local'] = True
+                instrumentation.add_bytes(array_nbytes(arr))
+                return arr
+
+            with self._lock:
+                var = self.dataset(path).variables[band]
+                arr = read_decimated(var, window, step)
+            instrumentation.add_bytes(array_nbytes(arr))
+            return arr
+
+    def get_bands(self, path, band_list, window=None, step=1):
+        """
+        Return a dict of band arrays, skipping bands missing in the scene
+        """
+        band_dict = {}
+        for band in band_list:
+            try:
+                band_dict[band] = self.get(path, band, window, step)
+            except KeyError:
+                continue
+
+        return band_dict
+
+    def close(self, path=None):
+        """
+        Drop the cached arrays and handles of a scene (or of every scene)
+        """
+        with self._lock:
+            for key in list(self._arrays):
+                if path is None or key[0] == path:
+                    self.nbytes -= array_nbytes(self._arrays.pop(key))
+
+            for p in list(self._datasets):
+                if path is None or p == path:
+                    self._datasets.pop(p).close()
+
+
+#Shared store used by the notebook
+store = BandStore()
@@ -0,0 +1,140 @@
+"""
+Benchmarks of the band I/O and index pipelines
+
+Times, on synthetic Landsat 8 and Sentinel-2 scenes (see synthetic.py):
+band loading, each water quality index, the band statistics and the RGB
+composite, with the peak memory allocated by each step. Every run starts
+from an empty band store, so disk reads are always included. Results can be
+saved as a baseline and later runs compared against it.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--size 2048] [--repeat 3]
+                                        [--save baseline.json]
+                                        [--baseline baseline.json] [--tolerance 0.2]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import band_store
+import utils_plot
+import wq_stats
+
+from synthetic import make_scenes
+
+rgb_bands = {'landsat': ['SRB4', 'SRB3', 'SRB2'], 'sentinel': ['B4', 'B3', 'B2']}
+
+def measure(func, repeat):
+    """
+    Best wall time (s) and peak traced memory (bytes) of func over repeats
+    """
+
+    best, peak = None, 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, peak
+
+def cases(scenes):
+    """
+    (name, function) of every benchmark; each function builds its own store
+    """
+
+    for sensor, path in sorted(scenes.items()):
+        bands = utils_plot.index_bands[sensor]
+
+        def load_all(path=path):
+            store = band_store.BandStore()
+            dataset = store.dataset(path)
+            names = [v for v in dataset.variables if dataset.variables[v].ndim == 2]
+            utils_plot.load_bands(path, dict((n, n) for n in names), store=store)
+            store.close()
+        yield '{}/load_bands'.format(sensor), load_all
+
+        for index in bands:
+            def index_case(path=path, index=index):
+                store = band_store.BandStore()
+                utils_plot.compute_index(path, index, store=store)
+                store.close()
+            yield '{}/index_{}'.format(sensor, index), index_case
+
+        def stats_case(path=path, band=rgb_bands[sensor][0]):
+            store = band_store.BandStore()
+            wq_stats.array_stats(store.get(path, band), (2.5, 97.5))
+            store.close()
+        yield '{}/stats'.format(sensor), stats_case
+
+        def rgb_case(path=path, sensor=sensor):
+            store = band_store.BandStore()
+            arrs = [store.get(path, b) for b in rgb_bands[sensor]]
+            utils_plot.color_composite(*arrs)
+            store.close()
+        yield '{}/rgb_composite'.format(sensor), rgb_case
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Band I/O and index benchmarks')
+    parser.add_argument('--size', type=int, default=2048, help='scene side in pixels')
+    parser.add_argument('--chunk', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'wq_sat_bench'),
+                        help='folder of the synthetic scenes (kept between runs)')
+    parser.add_argument('--filter', default='', help='only run benchmarks containing this text')
+    parser.add_argument('--save', help='write the result as a baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown / memory growth over the baseline (fraction)')
+    args = parser.parse_args()
+
+    scenes = make_scenes(args.data, args.size, args.chunk)
+
+    results = {}
+    print('{:<28} {:>10} {:>12}'.format('benchmark', 'time [s]', 'peak [MB]'))
+    for name, func in cases(scenes):
+        if args.filter not in name:
+            continue
+        elapsed, peak = measure(func, args.repeat)
+        results[name] = {'time_s': elapsed, 'peak_bytes': peak}
+        print('{:<28} {:>10.3f} {:>12.1f}'.format(name, elapsed, peak / 1024.**2))
+
+    report = {'size': args.size, 'chunk': args.chunk, 'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['size'] != args.size:
+            sys.exit('baseline was run with --size {}'.format(baseline['size']))
+
+        regressions = []
+        print('\n{:<28} {:>10} {:>12}'.format('vs baseline', 'time', 'peak'))
+        for name, r in sorted(results.items()):
+            if name not in baseline['results']:
+                continue
+            b = baseline['results'][name]
+            t_ratio = r['time_s'] / b['time_s']
+            m_ratio = r['peak_bytes'] / float(max(b['peak_bytes'], 1))
+            print('{:<28} {:>9.2f}x {:>11.2f}x'.format(name, t_ratio, m_ratio))
+            if t_ratio > 1 + args.tolerance or m_ratio > 1 + args.tolerance:
+                regressions.append(name)
+
+        if regressions:
+            sys.exit('performance regressions: {}'.format(', '.join(regressions)))
+
+if __name__ == '__main__':
+    main()
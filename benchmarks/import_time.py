@@ -0,0 +1,85 @@
+"""
+Import-time benchmark of the notebook module
+
+Imports xdc_sat_nb in fresh interpreters (python -X importtime) and reports
+the wall time and the slowest imports. Results can be saved as a baseline
+and later runs compared against it.
+
+Usage:
+    python benchmarks/import_time.py [--runs 5] [--save baseline.json]
+                                     [--baseline baseline.json] [--tolerance 0.2]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_once(module):
+    """
+    Wall time (s) of importing a module in a new interpreter and the
+    cumulative import time (us) of every module it pulled in
+    """
+
+    t0 = time.time()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                       cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    wall = time.time() - t0
+    if p.returncode != 0:
+        raise RuntimeError(p.stderr.strip().splitlines()[-1])
+
+    cumulative = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(cum_us)
+
+    return wall, cumulative
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Import-time benchmark')
+    parser.add_argument('--module', default='xdc_sat_nb')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--save', help='write the result as a baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown over the baseline (fraction)')
+    args = parser.parse_args()
+
+    walls, slowest = [], {}
+    for _ in range(args.runs):
+        wall, cumulative = import_once(args.module)
+        walls.append(wall)
+        for name, us in cumulative.items():
+            slowest[name] = min(us, slowest.get(name, us))
+
+    walls.sort()
+    median = walls[len(walls) // 2]
+    print('import {}: median {:.3f} s, best {:.3f} s ({} runs)'.format(args.module, median, walls[0], args.runs))
+    for name, us in sorted(slowest.items(), key=lambda kv: -kv[1])[:args.top]:
+        print('  {:>9.1f} ms  {}'.format(us / 1000., name))
+
+    result = {'module': args.module, 'median_s': median, 'best_s': walls[0],
+              'top': dict(sorted(slowest.items(), key=lambda kv: -kv[1])[:args.top])}
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        ratio = median / baseline['median_s']
+        print('vs baseline: {:.2f}x'.format(ratio))
+        if ratio > 1 + args.tolerance:
+            sys.exit('import time regression: {:.3f} s > {:.3f} s'.format(median, baseline['median_s']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Load test of the orchestrator submission and polling path
+
+Simulates many notebook users against the local mock IAM and orchestrator
+(see mock_orchestrator.py). Each user has its own OrchestratorClient, like
+a notebook kernel: it submits its deployments, opens the job list
+(job_monitor.JobMonitor) and polls it until its jobs are finished or the
+test ends. Latencies are taken from the 'http' spans of the client (see
+instrumentation), so they include retries and token refreshes.
+
+Reports, per operation (submit, list, status): request count, errors and
+p50/p99/max latency, plus the token refreshes and the responses served by
+status code. Results can be saved as a baseline and later runs compared
+against it.
+
+Usage:
+    python benchmarks/load_test.py [--users 50] [--jobs 2] [--duration 60]
+                                   [--interval 5] [--latency 0.05]
+                                   [--error-rate 0.01] [--token-lifetime 300]
+                                   [--save baseline.json]
+                                   [--baseline baseline.json] [--tolerance 0.2]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+import requests
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import orchestrator
+import job_monitor
+import instrumentation
+
+from mock_orchestrator import MockOrchestrator
+
+#TOSCA template sent with the submissions (its content is not parsed)
+tosca = 'tosca_definitions_version: tosca_simple_yaml_1_0\n'
+
+def operation(record):
+    """
+    Operation of an 'http' span: submit, list or status
+    """
+
+    if record.get('method') == 'POST':
+        return 'submit'
+
+    return 'list' if record.get('path', '').rstrip('/') == 'deployments' else 'status'
+
+def percentiles(seconds):
+    """
+    (p50, p99, max) of a list of latencies, in milliseconds
+    """
+
+    if not seconds:
+        return (0., 0., 0.)
+
+    s = np.asarray(seconds) * 1000.
+    return (float(np.percentile(s, 50)), float(np.percentile(s, 99)), float(s.max()))
+
+def simulate_user(n, mock, args, deadline, result):
+    """
+    One notebook user: submit, then poll the job list until done or deadline
+    """
+
+    environ = {'OAUTH2_REFRESH_TOKEN': 'user-{}'.format(n), 'IAM_CLIENT_ID': 'wq-sat',
+               'IAM_CLIENT_SECRET': 'mock'}
+    client = orchestrator.OrchestratorClient(mock.iam_url, mock.orchestrator_url, environ=environ,
+                                             retries=args.retries, backoff=args.backoff,
+                                             refresh_margin=args.refresh_margin, verbose=False)
+    monitor = job_monitor.JobMonitor(client, page_size=args.page_size)
+
+    # users do not all click at the same time
+    time.sleep(random.uniform(0, args.ramp))
+
+    regions = {'Region{}'.format(n): {'coordinates': {'W': -2.83, 'S': 41.82, 'E': -2.67, 'N': 41.90}}}
+    jobs = orchestrator.batch_sat_args(regions, '2019-01-01', '2019-12-31', 30)[:args.jobs]
+
+    errors = 0
+    for sat_args in jobs:
+        try:
+            client.launch(sat_args, tosca=tosca)
+        except (requests.RequestException, KeyError, ValueError):
+            errors += 1
+
+    while time.time() < deadline:
+        try:
+            if monitor.has_more:
+                monitor.load_more()
+            else:
+                monitor.check_new()
+                monitor.poll()
+        except requests.RequestException:
+            errors += 1
+        if not monitor.has_more and not monitor.pending():
+            break
+        time.sleep(args.interval)
+
+    statuses = [job['status'] for job in monitor.jobs.values()]
+    result[n] = {'token_requests': client.token_requests, 'errors': errors,
+                 'completed': statuses.count('CREATE_COMPLETE'), 'failed': statuses.count('CREATE_FAILED'),
+                 'pending': len(monitor.pending())}
+    client.close()
+
+def run(args):
+    """
+    Run the load test, returns the report dict
+    """
+
+    records = []
+
+    def listener(record):
+        if record['span'] == 'http':
+            records.append(record)
+
+    log_path, instrumentation.log_path = instrumentation.log_path, None
+    instrumentation.add_listener(listener)
+
+    mock = MockOrchestrator(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            token_lifetime=args.token_lifetime, job_seconds=args.job_seconds,
+                            fail_rate=args.fail_rate, seed=args.seed)
+    random.seed(args.seed)
+
+    users = {}
+    t0 = time.time()
+    deadline = t0 + args.duration
+    try:
+        with mock:
+            threads = [threading.Thread(target=simulate_user, args=(n, mock, args, deadline, users),
+                                        name='user-{}'.format(n)) for n in range(args.users)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+    finally:
+        instrumentation.remove_listener(listener)
+        instrumentation.log_path = log_path
+    elapsed = time.time() - t0
+
+    operations = {}
+    for op in ('submit', 'list', 'status'):
+        rs = [r for r in records if operation(r) == op]
+        failed = [r for r in rs if 'error' in r or r.get('status', 500) >= 400]
+        p50, p99, worst = percentiles([r['seconds'] for r in rs])
+        operations[op] = {'requests': len(rs), 'errors': len(failed),
+                          'p50_ms': p50, 'p99_ms': p99, 'max_ms': worst}
+
+    return {'users': args.users, 'jobs': args.jobs, 'seconds': elapsed,
+            'requests': len(records), 'requests_per_s': len(records) / elapsed,
+            'token_refreshes': sum(u['token_requests'] for u in users.values()),
+            'user_errors': sum(u['errors'] for u in users.values()),
+            'completed': sum(u['completed'] for u in users.values()),
+            'failed': sum(u['failed'] for u in users.values()),
+            'pending': sum(u['pending'] for u in users.values()),
+            'served': dict(mock.counts), 'operations': operations}
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Load test of the orchestrator submission and polling')
+    parser.add_argument('--users', type=int, default=50, help='concurrent notebook users')
+    parser.add_argument('--jobs', type=int, default=2, help='deployments submitted by each user')
+    parser.add_argument('--duration', type=float, default=60, help='maximum length of the test, s')
+    parser.add_argument('--ramp', type=float, default=5, help='users start within this time, s')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between two polls of a user')
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='fixed delay of the mock, s')
+    parser.add_argument('--jitter', type=float, default=0.02, help='mean extra exponential delay, s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--token-lifetime', type=float, default=300, help='access token lifetime, s')
+    parser.add_argument('--refresh-margin', type=float, default=5,
+                        help='seconds before expiry when the clients refresh their token')
+    parser.add_argument('--job-seconds', type=float, default=20, help='duration of a deployment, s')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of failed deployments')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the result as a baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p99 latency growth over the baseline (fraction)')
+    args = parser.parse_args()
+
+    report = run(args)
+
+    print('{} users, {} jobs each: {} requests in {:.1f} s ({:.1f} req/s)'.format(
+        report['users'], report['jobs'], report['requests'], report['seconds'], report['requests_per_s']))
+    print('token refreshes: {}, user errors: {}'.format(report['token_refreshes'], report['user_errors']))
+    print('jobs completed: {}, failed: {}, still pending: {}'.format(
+        report['completed'], report['failed'], report['pending']))
+    print('served: {}\n'.format(', '.join('{} {}'.format(k, v) for k, v in sorted(report['served'].items()))))
+
+    print('{:<10} {:>9} {:>7} {:>10} {:>10} {:>10}'.format('operation', 'requests', 'errors',
+                                                          'p50 [ms]', 'p99 [ms]', 'max [ms]'))
+    for op, r in report['operations'].items():
+        print('{:<10} {:>9} {:>7} {:>10.1f} {:>10.1f} {:>10.1f}'.format(op, r['requests'], r['errors'],
+                                                                     r['p50_ms'], r['p99_ms'], r['max_ms']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['users'], baseline['jobs']) != (args.users, args.jobs):
+            sys.exit('baseline was run with --users {} --jobs {}'.format(baseline['users'], baseline['jobs']))
+
+        regressions = []
+        print('\n{:<10} {:>10}'.format('vs baseline', 'p99'))
+        for op, r in sorted(report['operations'].items()):
+            b = baseline['operations'].get(op)
+            if not b or not b['requests'] or not r['requests']:
+                continue
+            ratio = r['p99_ms'] / max(b['p99_ms'], 1e-3)
+            print('{:<10} {:>9.2f}x'.format(op, ratio))
+            if ratio > 1 + args.tolerance:
+                regressions.append(op)
+
+        if regressions:
+            sys.exit('latency regressions: {}'.format(', '.join(regressions)))
+
+if __name__ == '__main__':
+    main()
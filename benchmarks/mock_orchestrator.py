@@ -0,0 +1,290 @@
+"""
+Local stand-in for the IAM and the PaaS orchestrator
+
+Serves the endpoints used by orchestrator.OrchestratorClient: the IAM
+token endpoint (refresh token grant) and the orchestrator deployments
+(submission, paginated list, conditional GET with ETag). Latency, error
+rate, token lifetime and job duration are configurable, so the submission
+and polling path can be measured without touching the real services.
+Deployments go from CREATE_IN_PROGRESS to CREATE_COMPLETE (or
+CREATE_FAILED) after job_seconds.
+
+Usage (standalone, e.g. for a notebook of the shared JupyterHub):
+    python benchmarks/mock_orchestrator.py [--port 8642] [--latency 0.05]
+                                           [--error-rate 0.01]
+
+then point the client to it:
+    orchestrator.client().iam_url = 'http://host:8642/token'
+    orchestrator.client().orchestrator_url = 'http://host:8642/orchestrator/'
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockOrchestrator(object):
+    """
+    Mock IAM and orchestrator served from a background thread
+
+    Parameters
+    ----------
+    latency: float
+        Fixed delay added to every response, seconds
+    jitter: float
+        Mean of an extra exponential delay, seconds
+    error_rate: float
+        Fraction of the requests answered with 503
+    token_lifetime: float
+        expires_in of the access tokens, seconds; expired tokens get a 401
+    job_seconds: float
+        Time a deployment stays CREATE_IN_PROGRESS
+    fail_rate: float
+        Fraction of the deployments ending as CREATE_FAILED
+    seed: int or None
+        Seed of the random latencies and errors
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, jitter=0.02, error_rate=0.0,
+                 token_lifetime=3600, job_seconds=10, fail_rate=0.0, seed=None):
+
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.token_lifetime, self.job_seconds, self.fail_rate = token_lifetime, job_seconds, fail_rate
+
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self._tokens = {}
+        self._deployments = {}
+        self._lock = threading.Lock()
+
+        handler = type('Handler', (_Handler,), {'mock': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def iam_url(self):
+
+        return self.url + '/token'
+
+    @property
+    def orchestrator_url(self):
+
+        return self.url + '/orchestrator/'
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self.server.serve_forever, name='mock-orchestrator')
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exc):
+
+        self.stop()
+
+    def _delay(self):
+
+        with self._lock:
+            delay = self.latency + (self._random.expovariate(1. / self.jitter) if self.jitter > 0 else 0.)
+            fail = self._random.random() < self.error_rate
+        time.sleep(delay)
+
+        return fail
+
+    def count(self, key):
+
+        with self._lock:
+            self.counts[key] += 1
+
+    def issue_token(self, refresh_token):
+        """
+        New access token of the user of a refresh token
+        """
+
+        token = 'mock-{}'.format(uuid.uuid4().hex)
+        with self._lock:
+            self._tokens[token] = (refresh_token, time.time() + self.token_lifetime)
+
+        return {'access_token': token, 'token_type': 'Bearer', 'expires_in': self.token_lifetime}
+
+    def user(self, authorization):
+        """
+        User of a bearer token, None if unknown or expired
+        """
+
+        token = (authorization or '').replace('Bearer ', '', 1)
+        with self._lock:
+            user, expiry = self._tokens.get(token, (None, 0.))
+
+        return user if time.time() < expiry else None
+
+    def create(self, user, body):
+
+        now = time.time()
+        with self._lock:
+            failed = self._random.random() < self.fail_rate
+            deployment = {'uuid': str(uuid.uuid4()), 'user': user, 'created': now,
+                          'final': 'CREATE_FAILED' if failed else 'CREATE_COMPLETE',
+                          'creationTime': time.strftime('%Y-%m-%dT%H:%M+0000', time.gmtime(now)),
+                          'parameters': body.get('parameters', {})}
+            self._deployments[deployment['uuid']] = deployment
+
+        return self.describe(deployment)
+
+    def describe(self, deployment):
+
+        done = time.time() - deployment['created'] >= self.job_seconds
+        return {'uuid': deployment['uuid'], 'creationTime': deployment['creationTime'],
+                'status': deployment['final'] if done else 'CREATE_IN_PROGRESS',
+                'parameters': deployment['parameters']}
+
+    def deployment(self, user, deployment_id):
+
+        with self._lock:
+            deployment = self._deployments.get(deployment_id)
+        if deployment is None or deployment['user'] != user:
+            return None
+
+        return self.describe(deployment)
+
+    def page(self, user, page, size):
+        """
+        One page of the deployments of a user, newest first
+        """
+
+        with self._lock:
+            own = [d for d in self._deployments.values() if d['user'] == user]
+        own.sort(key=lambda d: d['created'], reverse=True)
+
+        total_pages = (len(own) + size - 1) // size
+        content = [self.describe(d) for d in own[page * size:(page + 1) * size]]
+
+        return {'content': content,
+                'page': {'size': size, 'totalElements': len(own), 'totalPages': total_pages, 'number': page}}
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    mock = None
+
+    def log_message(self, *args):
+
+        pass
+
+    def _send(self, code, obj=None, headers=None):
+
+        body = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        endpoint = 'token' if self.path.startswith('/token') else self.command
+        self.mock.count('{} {}'.format(endpoint, code))
+
+    def _body(self):
+
+        n = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(n) if n else b''
+        try:
+            return json.loads(data.decode()) if data else {}
+        except ValueError:
+            return {}
+
+    def _route(self):
+
+        url = urlparse(self.path)
+        body = self._body()
+        fail = self.mock._delay()
+
+        if url.path == '/token':
+            if fail:
+                return self._send(503, {'error': 'temporarily_unavailable'})
+            query = parse_qs(url.query)
+            refresh = query.get('refresh_token', [body.get('refresh_token')])[0]
+            if not refresh:
+                return self._send(400, {'error': 'invalid_grant'})
+            return self._send(200, self.mock.issue_token(refresh))
+
+        parts = [p for p in url.path.split('/') if p]
+        if parts[:2] != ['orchestrator', 'deployments'] or len(parts) > 3:
+            return self._send(404, {'error': 'not found'})
+
+        if fail:
+            return self._send(503, {'error': 'service unavailable'})
+
+        user = self.mock.user(self.headers.get('Authorization'))
+        if user is None:
+            return self._send(401, {'error': 'invalid_token'})
+
+        if self.command == 'POST' and len(parts) == 2:
+            return self._send(201, self.mock.create(user, body))
+
+        if self.command == 'GET' and len(parts) == 2:
+            query = parse_qs(url.query)
+            page, size = int(query.get('page', ['0'])[0]), int(query.get('size', ['20'])[0])
+            return self._send(200, self.mock.page(user, page, size))
+
+        if self.command == 'GET':
+            deployment = self.mock.deployment(user, parts[2])
+            if deployment is None:
+                return self._send(404, {'error': 'not found'})
+            etag = '"{}"'.format(deployment['status'])
+            if self.headers.get('If-None-Match') == etag:
+                return self._send(304, headers={'ETag': etag})
+            return self._send(200, deployment, {'ETag': etag})
+
+        self._send(405, {'error': 'method not allowed'})
+
+    do_GET = _route
+    do_POST = _route
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Mock IAM and PaaS orchestrator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--latency', type=float, default=0.05, help='fixed delay of every response, s')
+    parser.add_argument('--jitter', type=float, default=0.02, help='mean extra exponential delay, s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--token-lifetime', type=float, default=3600, help='access token lifetime, s')
+    parser.add_argument('--job-seconds', type=float, default=60, help='duration of a deployment, s')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of failed deployments')
+    args = parser.parse_args()
+
+    mock = MockOrchestrator(args.host, args.port, args.latency, args.jitter, args.error_rate,
+                            args.token_lifetime, args.job_seconds, args.fail_rate)
+    print('IAM: {}\nOrchestrator: {}'.format(mock.iam_url, mock.orchestrator_url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+        print(dict(mock.counts))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Synthetic Landsat 8 and Sentinel-2 scenes for the benchmarks
+
+The files follow the layout of the real products: one 2D float32 variable
+per band with the same names (SRB1 ... SRB11 and B8 for Landsat 8, B2/B3/B4/B8
+and SRB* for Sentinel-2), 1D lat/lon coordinates, compressed chunks, and a
+water body (a lake where NDWI > 0) in the middle of the scene.
+"""
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+landsat_bands = ['SRB1', 'SRB2', 'SRB3', 'SRB4', 'SRB5', 'SRB6', 'SRB7', 'B8', 'SRB9', 'SRB10', 'SRB11']
+sentinel_bands = ['SRB1', 'B2', 'B3', 'B4', 'SRB5', 'SRB6', 'SRB7', 'B8', 'SRB8A', 'SRB9', 'SRB10',
+                  'SRB11', 'SRB12']
+
+#File names parsed like the real ones (Landsat: YYYYDDD at [9:16], Sentinel-2: YYYYMMDD at [11:19])
+landsat_name = 'LC82000312019123LGN00.nc'
+sentinel_name = 'S2A_MSIL2A_20190512T105031_N0212_R051_T30TWM.nc'
+
+def make_scene(path, bands, size, chunk=256, seed=0, extent=(-2.9, 41.7, -2.6, 42.0)):
+    """
+    Write a size x size synthetic scene, strip by strip
+    """
+
+    rng = np.random.RandomState(seed)
+    W, S, E, N = extent
+
+    with Dataset(path, 'w', format='NETCDF4_CLASSIC') as nc:
+        nc.createDimension('lat', size)
+        nc.createDimension('lon', size)
+        lat = nc.createVariable('lat', 'f8', ('lat',))
+        lon = nc.createVariable('lon', 'f8', ('lon',))
+        lat[:] = np.linspace(N, S, size)
+        lon[:] = np.linspace(W, E, size)
+
+        variables = {}
+        for b in bands:
+            variables[b] = nc.createVariable(b, 'f4', ('lat', 'lon'), zlib=True, complevel=1,
+                                             chunksizes=(min(chunk, size), min(chunk, size)))
+
+        cols = np.arange(size) - size / 2.
+        for r0 in range(0, size, chunk):
+            r1 = min(r0 + chunk, size)
+            rows = np.arange(r0, r1)[:, None] - size / 2.
+            lake = (rows**2 + cols[None, :]**2) < (size / 4.)**2
+
+            for n, b in enumerate(bands):
+                strip = rng.uniform(0.02, 0.3, (r1 - r0, size)).astype('float32')
+                # water: bright green, dark near infrared
+                if b in ('SRB3', 'B3'):
+                    strip[lake] += 0.2
+                elif b in ('SRB5', 'B8', 'SRB8A'):
+                    strip[lake] *= 0.2
+                variables[b][r0:r1, :] = strip
+
+    return path
+
+def make_scenes(folder, size, chunk=256):
+    """
+    One Landsat 8 and one Sentinel-2 scene in folder, reused if present
+    """
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    scenes = {}
+    for sensor, name, bands in (('landsat', landsat_name, landsat_bands),
+                                ('sentinel', sentinel_name, sentinel_bands)):
+        # one folder per size, the file names must stay parseable
+        path = os.path.join(folder, str(size), name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if not os.path.isfile(path):
+            make_scene(path, bands, size, chunk)
+        scenes[sensor] = path
+
+    return scenes
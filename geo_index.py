@@ -0,0 +1,200 @@
+"""
+Geospatial index of the scenes
+
+Maps a polygon (a regions.json box or a shape drawn on the map) to the
+pixel window of a scene and to a pixel mask of the polygon, so bands,
+indices and statistics only read and compute the pixels of a reservoir.
+The lat/lon grid of each scene is read once; windows and masks are
+computed once per grid, so the scenes of a region sharing one grid share
+them too.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import band_store
+import utils_plot
+
+#Rasterized masks kept in memory
+max_masks = 64
+
+_grids = {}
+_windows = {}
+_masks = OrderedDict()
+_lock = threading.Lock()
+
+def box_polygon(coordinates):
+    """
+    Polygon [(lon, lat), ...] of a W/S/E/N box (regions.json coordinates)
+    """
+
+    W, S, E, N = coordinates['W'], coordinates['S'], coordinates['E'], coordinates['N']
+
+    return [(W, S), (E, S), (E, N), (W, N)]
+
+def geojson_polygon(geometry):
+    """
+    Polygon of a GeoJSON Polygon geometry (e.g. DrawControl.last_draw)
+
+    The map may be on another copy of the world, longitudes are brought
+    back to [-180, 180).
+    """
+
+    if geometry['type'] != 'Polygon':
+        raise ValueError('Only polygons can be used to clip, not {}'.format(geometry['type']))
+
+    ring = geometry['coordinates'][0]
+    if ring[0] == ring[-1]:
+        ring = ring[:-1]
+
+    return [((lon + 180.) % 360. - 180., lat) for lon, lat in ring]
+
+def polygon_key(polygon):
+    """
+    Hashable key of a polygon
+    """
+
+    if polygon is None:
+        return None
+
+    return tuple((round(float(x), 6), round(float(y), 6)) for x, y in polygon)
+
+def grid(datepath, store=None):
+    """
+    (lat, lon, key) of a scene: its 1D coordinate axes and a hash shared
+    by the scenes on the same grid
+    """
+
+    if datepath in _grids:
+        return _grids[datepath]
+
+    if store is None:
+        store = band_store.store
+
+    dataset = store.dataset(datepath)
+    lat = utils_plot.coordinate_axis(dataset, ('lat', 'latitude'), 0)
+    lon = utils_plot.coordinate_axis(dataset, ('lon', 'longitude'), 1)
+    if lat is None or lon is None:
+        _grids[datepath] = None
+        return None
+
+    key = hashlib.md5(lat.astype('float64').tobytes() + lon.astype('float64').tobytes()).hexdigest()
+    _grids[datepath] = (lat, lon, key)
+
+    return _grids[datepath]
+
+def polygon_window(datepath, polygon, store=None):
+    """
+    Pixel window (row_start, row_stop, col_start, col_stop) of the bounding
+    box of a polygon
+
+    Returns None (whole scene) if the scene has no lat/lon grid or the
+    polygon does not overlap it.
+    """
+
+    g = grid(datepath, store)
+    if g is None or polygon is None:
+        return None
+
+    lat, lon, key = g
+    wkey = (key, polygon_key(polygon))
+    if wkey in _windows:
+        return _windows[wkey]
+
+    xs, ys = zip(*polygon)
+    rows = np.where((lat >= min(ys)) & (lat <= max(ys)))[0]
+    cols = np.where((lon >= min(xs)) & (lon <= max(xs)))[0]
+
+    window = None
+    if rows.size and cols.size:
+        window = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+
+    _windows[wkey] = window
+
+    return window
+
+def rasterize(polygon, lat, lon):
+    """
+    Boolean mask of the pixels centred outside a polygon (True outside)
+
+    Scanline fill: the edge crossings of every row are found at once,
+    then the columns between pairs of crossings are filled.
+    """
+
+    xs = np.array([p[0] for p in polygon], dtype='float64')
+    ys = np.array([p[1] for p in polygon], dtype='float64')
+    x0, y0, x1, y1 = xs, ys, np.roll(xs, -1), np.roll(ys, -1)
+
+    Y = np.asarray(lat, dtype='float64')[:, None]
+    crosses = (y0 <= Y) != (y1 <= Y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = x0 + (Y - y0) * (x1 - x0) / (y1 - y0)
+
+    order = np.argsort(lon)
+    sorted_lon = np.asarray(lon)[order]
+
+    inside = np.zeros((len(lat), len(lon)), dtype=bool)
+    for r in np.nonzero(crosses.any(axis=1))[0]:
+        bounds = np.searchsorted(sorted_lon, np.sort(X[r, crosses[r]]))
+        for a, b in zip(bounds[0::2], bounds[1::2]):
+            inside[r, order[a:b]] = True
+
+    return ~inside
+
+def polygon_mask(datepath, polygon, window=None, step=1, store=None):
+    """
+    Mask of the pixels of a (decimated) window outside a polygon, True
+    outside; rasterized once per grid, polygon, window and step
+    """
+
+    g = grid(datepath, store)
+    if g is None:
+        return None
+
+    lat, lon, key = g
+    mkey = (key, polygon_key(polygon), window, step)
+    with _lock:
+        if mkey in _masks:
+            _masks.move_to_end(mkey)
+            return _masks[mkey]
+
+    rows, cols = band_store.window_slices(window, step)
+    mask = rasterize(polygon, lat[rows], lon[cols])
+    mask.flags.writeable = False
+
+    with _lock:
+        _masks[mkey] = mask
+        while len(_masks) > max_masks:
+            _masks.popitem(last=False)
+
+    return mask
+
+def clip(arr, datepath, polygon, window=None, step=1, store=None):
+    """
+    Masked array of a band or index window with the pixels outside a
+    polygon masked (arr itself if there is no polygon or grid)
+    """
+
+    if polygon is None:
+        return arr
+
+    mask = polygon_mask(datepath, polygon, window, step, store)
+    if mask is None:
+        return arr
+
+    return np.ma.masked_array(np.ma.getdata(arr), mask=np.ma.getmaskarray(arr) | mask, copy=False)
+
+def clear(datepath=None):
+    """
+    Forget the grids of a scene (or of every scene) and their masks
+    """
+
+    with _lock:
+        if datepath is None:
+            _grids.clear()
+        else:
+            _grids.pop(datepath, None)
+        _windows.clear()
+        _masks.clear()
@@ -0,0 +1,266 @@
+"""
+Timing spans for the visualization pipeline
+
+span() records the duration, bytes read and peak traced memory of a stage
+(band read, index, statistics, composite, rendering, HTTP call) and sends
+it to a JSON lines log and to the listeners registered with add_listener
+(e.g. the diagnostics panel of the notebook). Nested spans keep their
+parent, so the time of a click can be broken down stage by stage. The log
+is written in batches, so the spans of bulk jobs (composites, cubes, time
+series) are not flushed one by one.
+"""
+import os
+import json
+import time
+import atexit
+import itertools
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+#JSON lines log, off unless set (the notebook sets it to default_log_path)
+log_path = None
+default_log_path = os.path.join(os.path.expanduser('~'), '.wq_sat', 'timings.jsonl')
+
+#Size at which the log is moved to <log_path>.1 and started again
+max_log_bytes = 10 * 1024**2
+
+#Records held before they are written to the log; a user action (see
+#new_action) is written when its top level span ends
+log_buffer = 500
+
+#Trace Python/NumPy allocations to report the peak memory of each span
+#(tracemalloc slows the traced code down, so it is off unless diagnosing)
+trace_memory = False
+
+enabled = True
+
+_listeners = []
+_local = threading.local()
+_log_lock = threading.Lock()
+_log = None
+_pending = []
+_actions = itertools.count(1)
+
+def add_listener(func):
+    """
+    Call func(record) for every finished span
+    """
+
+    _listeners.append(func)
+
+def remove_listener(func):
+
+    if func in _listeners:
+        _listeners.remove(func)
+
+def _stack():
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def add_bytes(nbytes):
+    """
+    Count bytes read in the current span (and its parents)
+    """
+
+    for record in _stack():
+        record['bytes'] += int(nbytes)
+
+def new_action():
+    """
+    Id of a user action; spans opened with action=<id> and their stages
+    are grouped under it, whatever thread they run on
+    """
+
+    return next(_actions)
+
+def _write_log(lines):
+    """
+    Append to the log, kept open, and rotate it past max_log_bytes
+    """
+
+    global _log
+
+    if _log is None or _log[0] != log_path:
+        if _log is not None:
+            _log[1].close()
+        folder = os.path.dirname(log_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        _log = (log_path, open(log_path, 'a'))
+
+    f = _log[1]
+    f.write(lines)
+    f.flush()
+    if f.tell() > max_log_bytes:
+        f.close()
+        _log = None
+        os.replace(log_path, log_path + '.1')
+
+def flush_log():
+    """
+    Write the buffered records to the log
+    """
+
+    with _log_lock:
+        lines = ''.join(_pending)
+        del _pending[:]
+        if lines and log_path is not None:
+            try:
+                _write_log(lines)
+            except OSError:
+                pass
+
+atexit.register(flush_log)
+
+def _emit(record):
+
+    if log_path is not None:
+        with _log_lock:
+            _pending.append(json.dumps(record) + '\n')
+            flush = len(_pending) >= log_buffer or (record['depth'] == 0 and 'action' in record)
+        if flush:
+            flush_log()
+
+    for func in list(_listeners):
+        func(record)
+
+@contextmanager
+def span(name, **fields):
+    """
+    Time a stage; extra keyword fields are stored in the record
+    """
+
+    if not enabled:
+        yield None
+        return
+
+    stack = _stack()
+    record = {'span': name, 'parent': stack[-1]['span'] if stack else None,
+              'depth': len(stack), 'thread': threading.current_thread().name,
+              'start': time.time(), 'bytes': 0}
+    record.update(fields)
+    if stack and 'action' in stack[-1]:
+        record.setdefault('action', stack[-1]['action'])
+
+    own_trace = trace_memory and not tracemalloc.is_tracing()
+    if own_trace:
+        tracemalloc.start()
+    if tracemalloc.is_tracing():
+        _track_peak(stack)
+        record['_base'] = tracemalloc.get_traced_memory()[0]
+        record['peak_bytes'] = 0
+
+    stack.append(record)
+    t0 = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - t0
+        if tracemalloc.is_tracing() and '_base' in record:
+            _track_peak(stack)
+        stack.pop()
+        record.pop('_base', None)
+        if own_trace:
+            tracemalloc.stop()
+        _emit(record)
+
+def _track_peak(stack):
+    """
+    Fold the traced peak into the open spans and start a new peak, so a
+    span only reports the memory allocated while it was running
+    """
+
+    peak = tracemalloc.get_traced_memory()[1]
+    for r in stack:
+        if '_base' in r:
+            r['peak_bytes'] = max(r['peak_bytes'], peak - r['_base'])
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+def timed(name=None):
+    """
+    Decorator wrapping a function in a span
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def read_log(path=None):
+    """
+    Records of the JSON lines log
+    """
+
+    flush_log()
+    with open(path or log_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class Recorder(object):
+    """
+    Keeps the last spans in memory, e.g. for a diagnostics panel
+    """
+
+    def __init__(self, maxlen=200):
+
+        self.maxlen = maxlen
+        self.records = []
+        self._lock = threading.Lock()
+        add_listener(self)
+
+    def __call__(self, record):
+
+        with self._lock:
+            self.records.append(record)
+            del self.records[:-self.maxlen]
+
+    def summary(self, spans=1, action=None):
+        """
+        Text table of the last top level spans and their stages, or of
+        every span of a user action (see new_action)
+        """
+        with self._lock:
+            records = list(self.records)
+        if action is not None:
+            records = [r for r in records if r.get('action') == action]
+            spans = len(records)
+
+        # the stages of a span are emitted before it
+        first, found = len(records), 0
+        while first > 0 and found < spans:
+            first -= 1
+            if records[first]['depth'] == 0:
+                found += 1
+                while first > 0 and records[first - 1]['depth'] > 0:
+                    first -= 1
+        if not found:
+            return ''
+
+        lines = ['{:<32} {:>9} {:>10} {:>10}'.format('stage', 'ms', 'read MB', 'peak MB')]
+        group = []
+        for r in records[first:]:
+            group.append(r)
+            if r['depth'] > 0:
+                continue
+            # parent first, then its stages in the order they finished
+            for g in [r] + group[:-1]:
+                lines.append('{:<32} {:>9.1f} {:>10.1f} {:>10.1f}'.format(
+                    '  ' * g['depth'] + g['span'], g['seconds'] * 1000, g['bytes'] / 1024.**2,
+                    g.get('peak_bytes', 0) / 1024.**2))
+            group = []
+
+        return '\n'.join(lines)
@@ -0,0 +1,208 @@
+"""
+Local table of orchestrator deployments with background polling
+
+Pages of the deployment list are fetched lazily, and only the jobs that are
+not finished are polled (conditional requests with ETag), so the Jobs tab
+neither stalls the notebook startup nor downloads every deployment again.
+"""
+import threading
+from collections import OrderedDict
+
+import requests
+
+import orchestrator
+
+#Statuses after which a deployment does not change any more
+terminal_status = set(['CREATE_COMPLETE', 'CREATE_FAILED', 'UPDATE_COMPLETE', 'UPDATE_FAILED',
+                       'DELETE_COMPLETE', 'DELETE_FAILED'])
+
+def job_label(job):
+    """
+    Text shown for a deployment in the job list
+    """
+
+    return 'ID: ' + job['uuid'] + ' | Creation time: ' + job['creationTime'] + ' | Status: ' + job['status']
+
+class JobMonitor(object):
+    """
+    Deployments of the user, updated incrementally
+
+    Parameters
+    ----------
+    client: orchestrator.OrchestratorClient or None
+        Shared client if None
+    page_size: int
+        Deployments fetched per page
+    interval: float
+        Seconds between two polls of the unfinished jobs
+    on_change: callable or None
+        on_change(monitor) is called after the table changed
+    """
+
+    def __init__(self, client=None, page_size=20, interval=30, on_change=None):
+
+        self.client = client
+        self.page_size = page_size
+        self.interval = interval
+        self.on_change = on_change
+
+        self.jobs = OrderedDict()
+        self._etags = {}
+        self.next_page = 0
+        self.total_pages = None
+        self._lock = threading.RLock()
+        # held while paging, so the UI and the polling thread do not fetch
+        # the same page or move next_page under each other
+        self._paging = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _client(self):
+
+        return self.client if self.client is not None else orchestrator.client()
+
+    def _changed(self):
+
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def _store(self, job):
+        """
+        Add or update a deployment, returns True if something changed
+        """
+        fields = dict((k, job.get(k, '')) for k in ('uuid', 'creationTime', 'status'))
+        with self._lock:
+            if self.jobs.get(fields['uuid']) == fields:
+                return False
+            self.jobs[fields['uuid']] = fields
+            return True
+
+    @property
+    def has_more(self):
+
+        return self.total_pages is None or self.next_page < self.total_pages
+
+    def load_more(self):
+        """
+        Fetch the next page of (older) deployments
+        """
+        with self._paging:
+            if not self.has_more:
+                return 0
+
+            content, page = self._client().deployments_page(self.next_page, self.page_size)
+            with self._lock:
+                self.total_pages = page.get('totalPages', self.next_page + 1 if content else self.next_page)
+                self.next_page += 1
+
+        changed = [self._store(job) for job in content]
+        if any(changed):
+            self._changed()
+
+        return len(content)
+
+    def check_new(self):
+        """
+        Look for deployments created since the last check, paging until a
+        known one is reached (a batch may fill more than one page)
+        """
+        new = []
+        with self._paging:
+            page = 0
+            while True:
+                content, info = self._client().deployments_page(page, self.page_size)
+                with self._lock:
+                    known = [job['uuid'] in self.jobs for job in content]
+                new += [job for job, k in zip(content, known) if not k]
+                page += 1
+                if (any(known) or not content or not self.jobs or
+                        page >= info.get('totalPages', page)):
+                    break
+
+            if not new:
+                return 0
+
+            with self._lock:
+                # newest first
+                old = list(self.jobs.items())
+                self.jobs.clear()
+                for job in new:
+                    self._store(job)
+                self.jobs.update(old)
+                # the new jobs pushed the older ones towards later pages
+                self.next_page += len(new) // self.page_size
+                if self.total_pages is not None:
+                    self.total_pages = max(self.total_pages, info.get('totalPages', self.total_pages))
+
+        self._changed()
+
+        return len(new)
+
+    def pending(self):
+        """
+        uuids of the deployments that may still change
+        """
+        with self._lock:
+            return [uuid for uuid, job in self.jobs.items() if job['status'] not in terminal_status]
+
+    def poll(self):
+        """
+        Refresh the unfinished deployments, returns how many changed
+        """
+        changed = 0
+        for uuid in self.pending():
+            try:
+                job, etag = self._client().deployment(uuid, self._etags.get(uuid))
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # deleted: finished for good, the other jobs are still polled
+                with self._lock:
+                    job = dict(self.jobs[uuid], status='DELETE_COMPLETE')
+                etag = None
+            if etag:
+                self._etags[uuid] = etag
+            if job is not None and self._store(job):
+                changed += 1
+
+        if changed:
+            self._changed()
+
+        return changed
+
+    def _run(self):
+
+        while not self._stop.is_set():
+            try:
+                if not self.jobs:
+                    self.load_more()
+                else:
+                    self.check_new()
+                    self.poll()
+            except requests.RequestException as e:
+                print('Job monitor: {}'.format(e))
+            except Exception as e:
+                # e.g. KeyError without OAUTH2_REFRESH_TOKEN / IAM_CLIENT_* set
+                print('Job monitor: {!r}'.format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Poll in a background thread every `interval` seconds
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='job-monitor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+
+        self._stop.set()
+
+    def options(self):
+        """
+        (label, uuid) pairs for a Select widget, newest first
+        """
+        with self._lock:
+            return [(job_label(job), uuid) for uuid, job in self.jobs.items()]
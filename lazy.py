@@ -0,0 +1,29 @@
+"""
+Deferred imports
+
+lazy_import returns a module whose code only runs when one of its
+attributes is first used, so heavy modules (netCDF4, requests, the data
+and orchestrator helpers) do not slow down the notebook startup.
+"""
+import sys
+import importlib.util
+
+def lazy_import(name):
+    """
+    Module `name`, executed on first attribute access
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {}'.format(name))
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
@@ -0,0 +1,258 @@
+"""
+Local, memory-mappable copies of the scenes
+
+A scene converted with convert() is kept on the local disk as one
+uncompressed .npy file per band (float32, or int16 with a scale and
+offset), a .mask.npy file for bands with masked pixels and a meta.json
+sidecar. While the copy is up to date with its source, band_store reads
+the bands through np.memmap views instead of decompressing the NetCDF on
+the (Onedata) mount, so a band switch only pages in the pixels it shows.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+import band_store
+import utils_plot
+
+#Folder of the local copies, on a local (SSD) disk
+local_folder = os.path.join(os.path.expanduser('~'), '.wq_sat', 'scenes')
+
+#Read through the local copies when they exist
+enabled = True
+
+#Rows converted at a time
+strip_rows = 512
+
+#Format version of the copies, bumped when the layout changes
+format_version = 2
+
+#(source mtime and size, valid sidecar or None) by scene path
+_meta = {}
+
+def scene_folder(datepath):
+    """
+    Folder of the local copy of a scene
+    """
+
+    return os.path.join(local_folder, os.path.splitext(os.path.basename(datepath))[0])
+
+def _source_stat(datepath):
+
+    st = os.stat(datepath)
+    return st.st_mtime, st.st_size
+
+def _load_meta(datepath, stat):
+
+    try:
+        with open(os.path.join(scene_folder(datepath), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (meta.get('format_version') != format_version or
+            meta.get('source') != os.path.abspath(datepath) or
+            (meta.get('source_mtime'), meta.get('source_size')) != stat):
+        return None
+
+    return meta
+
+def metadata(datepath):
+    """
+    Sidecar of the local copy of a scene, or None if missing or out of date
+
+    The sidecar is read once per scene and process (see forget()), but the
+    source is checked with os.stat on every call, so a copy is dropped as
+    soon as its source changes.
+    """
+
+    try:
+        stat = _source_stat(datepath)
+    except OSError:
+        return None
+
+    cached = _meta.get(datepath)
+    if cached is None or cached[0] != stat:
+        cached = _meta[datepath] = (stat, _load_meta(datepath, stat))
+
+    return cached[1]
+
+def forget(datepath=None):
+    """
+    Check the local copy of a scene (or of every scene) again on next read
+    """
+
+    if datepath is None:
+        _meta.clear()
+    else:
+        _meta.pop(datepath, None)
+
+def _strips(store, datepath, band, shape):
+
+    nrows, ncols = shape
+    for r0 in range(0, nrows, strip_rows):
+        yield r0, store.read(datepath, band, (r0, min(r0 + strip_rows, nrows), 0, ncols))
+
+def _band_range(store, datepath, band, shape):
+
+    lo, hi = np.inf, -np.inf
+    for r0, strip in _strips(store, datepath, band, shape):
+        strip = np.ma.masked_invalid(strip)
+        if strip.count():
+            lo, hi = min(lo, strip.min()), max(hi, strip.max())
+
+    return (float(lo), float(hi)) if lo <= hi else (0., 0.)
+
+def convert(datepath, bands=None, dtype='float32', check=None):
+    """
+    Write the local copy of a scene, strip by strip
+
+    The scene is read through the shared band store, whose lock keeps the
+    NetCDF reads of a background conversion and of the plots apart.
+
+    Parameters
+    ----------
+    bands: list or None
+        Variables to copy, every 2D variable if None
+    dtype: str
+        'float32' (exact) or 'int16' (half the size, scaled to the range
+        of each band)
+    check: callable or None
+        Called before each band, raises to cancel the conversion (e.g.
+        async_tasks.Token.check); the partial copy is removed
+
+    Returns the folder of the copy.
+    """
+
+    if dtype not in ('float32', 'int16'):
+        raise ValueError('dtype must be float32 or int16')
+
+    # read the source, not the copy being replaced
+    _meta[datepath] = (_source_stat(datepath), None)
+    store = band_store.store
+
+    folder = scene_folder(datepath)
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    meta = {'format_version': format_version, 'source': os.path.abspath(datepath),
+            'source_mtime': os.path.getmtime(datepath), 'source_size': os.path.getsize(datepath),
+            'dtype': dtype, 'bands': {}}
+
+    try:
+        variables = store.dataset(datepath).variables
+        if bands is None:
+            bands = [v for v in variables if variables[v].ndim == 2]
+        shapes = dict((band, variables[band].shape) for band in bands)
+
+        for band in bands:
+            if check is not None:
+                check()
+            shape = shapes[band]
+            info = {'shape': list(shape), 'masked': False}
+            if dtype == 'int16':
+                # -32768 is left for the masked pixels
+                lo, hi = _band_range(store, datepath, band, shape)
+                info['offset'] = (lo + hi) / 2.
+                info['scale'] = (hi - lo) / 65534. or 1.
+
+            data = np.lib.format.open_memmap(os.path.join(tmp_folder, band + '.npy'), mode='w+',
+                                             dtype=dtype, shape=shape)
+            mask = np.lib.format.open_memmap(os.path.join(tmp_folder, band + '.mask.npy'), mode='w+',
+                                             dtype=bool, shape=shape)
+
+            for r0, strip in _strips(store, datepath, band, shape):
+                strip_mask = np.ma.getmaskarray(strip)
+                if dtype == 'int16':
+                    values = (np.ma.getdata(strip) - info['offset']) / info['scale']
+                    values = np.where(strip_mask | ~np.isfinite(values), -32768,
+                                      np.clip(np.round(values), -32767, 32767))
+                else:
+                    values = np.ma.getdata(strip)
+                data[r0:r0 + strip.shape[0]] = values
+                mask[r0:r0 + strip.shape[0]] = strip_mask
+                info['masked'] = info['masked'] or bool(strip_mask.any())
+
+            data.flush()
+            del data, mask
+            if not info['masked']:
+                os.remove(os.path.join(tmp_folder, band + '.mask.npy'))
+
+            meta['bands'][band] = info
+
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+        # readers never see a half written copy
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.rename(tmp_folder, folder)
+
+    except Exception:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        forget(datepath)
+        raise
+
+    forget(datepath)
+
+    return folder
+
+def convert_region(region_path, satellite=None, start=None, end=None, dtype='float32'):
+    """
+    Local copies of the scenes of a region that do not have an up to date one
+    """
+
+    folders = []
+    for date, f in utils_plot.region_scenes(region_path, satellite, start, end):
+        datepath = os.path.join(region_path, f)
+        if metadata(datepath) is None:
+            convert(datepath, dtype=dtype)
+        folders.append(scene_folder(datepath))
+
+    return folders
+
+def read(datepath, band, window=None, step=1):
+    """
+    Masked array of a band (window) from the local copy, None without copy
+
+    float32 copies are returned as read-only memmap views (no copy);
+    int16 ones are decoded to float32.
+    """
+
+    if not enabled:
+        return None
+
+    meta = metadata(datepath)
+    if meta is None or band not in meta['bands']:
+        return None
+
+    info = meta['bands'][band]
+    folder = scene_folder(datepath)
+
+    index = band_store.window_slices(window, step)
+    data = np.load(os.path.join(folder, band + '.npy'), mmap_mode='r')[index]
+    mask = np.ma.nomask
+    if info['masked']:
+        mask = np.load(os.path.join(folder, band + '.mask.npy'), mmap_mode='r')[index]
+
+    if meta['dtype'] == 'int16':
+        data = data.astype('float32')
+        data *= info['scale']
+        data += info['offset']
+
+    return np.ma.masked_array(data, mask=mask, copy=False)
+
+def remove(datepath=None):
+    """
+    Delete the local copy of a scene (or every local copy)
+    """
+
+    folder = local_folder if datepath is None else scene_folder(datepath)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+
+    forget(datepath)
@@ -0,0 +1,368 @@
+"""
+XYZ tiles of bands, RGB composites and indices for the ipyleaflet map
+
+Tiles are rendered in the kernel, on demand, from the scene files: each
+256 x 256 Web Mercator tile reads only the pixel window it covers,
+decimated to the zoom level, and is kept PNG encoded in an LRU cache.
+TileOverlay follows the view of a Map and draws the visible tiles as image
+overlays, so panning a reservoir at full resolution renders a handful of
+tiles instead of the whole raster.
+"""
+import io
+import os
+import base64
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import band_store
+import utils_plot
+import wq_tiles
+import wq_stats
+import product_cache
+
+tile_size = 256
+
+#Rendered tiles kept in memory
+max_tiles = 1024
+
+def tile_bounds(z, x, y):
+    """
+    (south, west, north, east) of a Web Mercator tile, in degrees
+    """
+
+    n = 2.0 ** z
+    west, east = x / n * 360. - 180., (x + 1) / n * 360. - 180.
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+
+    return south, west, north, east
+
+def tile_index(lat, lon, z):
+    """
+    (x, y) of the tile holding a point
+    """
+
+    n = 2 ** z
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = int((lon + 180.) / 360. * n)
+    y = int((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2. * n)
+
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def visible_tiles(bounds, z):
+    """
+    Tiles (x, y) covering ((south, west), (north, east)) at zoom z
+    """
+
+    (south, west), (north, east) = bounds
+    x0, y0 = tile_index(north, west, z)
+    x1, y1 = tile_index(south, east, z)
+
+    return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+def _nearest(axis, values):
+    """
+    Nearest index along a monotonic coordinate axis, -1 outside of it
+    """
+
+    order = np.argsort(axis)
+    sorted_axis = axis[order]
+    half = abs(sorted_axis[-1] - sorted_axis[0]) / max(axis.size - 1, 1) / 2.
+
+    pos = np.clip(np.searchsorted(sorted_axis, values), 1, axis.size - 1)
+    left, right = sorted_axis[pos - 1], sorted_axis[pos]
+    pos -= values - left < right - values
+    index = order[pos]
+
+    outside = (values < sorted_axis[0] - half) | (values > sorted_axis[-1] + half)
+    index[outside] = -1
+
+    return index
+
+class TileCache(object):
+    """
+    LRU cache of the rendered tiles, shared by the tile sources
+    """
+
+    def __init__(self, max_tiles=max_tiles):
+
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+            if key not in self._tiles:
+                return None
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+    def put(self, key, png):
+
+        with self._lock:
+            self._tiles[key] = png
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+        return png
+
+    def clear(self, datepath=None):
+
+        with self._lock:
+            for key in list(self._tiles):
+                if datepath is None or key[0] == datepath:
+                    del self._tiles[key]
+
+#Cache used by the notebook
+cache = TileCache()
+
+class TileSource(object):
+    """
+    Renders the tiles of one layer of a scene
+
+    Parameters
+    ----------
+    kind: str
+        'band', 'index' or 'rgb'
+    layer: str or list
+        Band variable, index name, or the three bands of an RGB composite
+    cmap: str
+        Matplotlib colormap of the band and index tiles
+    limits: list or None
+        (low, high) stretch limits of each band, e.g. from the statistics of
+        the plot already shown; taken from the scene preview if None
+
+    The stretch limits are set once, so that neighbouring tiles share the
+    same colours.
+    """
+
+    def __init__(self, datepath, kind, layer, cmap='Greys', store=None, cache=cache, limits=None):
+
+        if store is None:
+            store = band_store.store
+
+        self.datepath, self.kind, self.layer, self.cmap = datepath, kind, layer, cmap
+        self.store, self.cache = store, cache
+        # tiles of a replaced scene are not served from the cache
+        self.mtime = os.path.getmtime(datepath)
+
+        dataset = store.dataset(datepath)
+        self.lat = utils_plot.coordinate_axis(dataset, ('lat', 'latitude'), 0)
+        self.lon = utils_plot.coordinate_axis(dataset, ('lon', 'longitude'), 1)
+        if self.lat is None or self.lon is None:
+            raise ValueError('{} has no lat/lon grid'.format(datepath))
+
+        self.limits = self._limits() if limits is None else [tuple(l) for l in limits]
+
+    @property
+    def key(self):
+
+        layer = tuple(self.layer) if self.kind == 'rgb' else self.layer
+        return (self.datepath, self.mtime, self.kind, layer, self.cmap, tuple(self.limits))
+
+    @property
+    def bounds(self):
+        """
+        ((south, west), (north, east)) of the scene
+        """
+
+        return ((float(self.lat.min()), float(self.lon.min())),
+                (float(self.lat.max()), float(self.lon.max())))
+
+    def _limits(self):
+
+        window, step = utils_plot.preview_read(self.datepath, store=self.store)
+
+        if self.kind == 'index':
+            arr = product_cache.cached_index(self.datepath, self.layer, self.store, window, step)
+            st = wq_stats.cached_stats(self.datepath, self.layer, arr, window, step)
+            return [(st['min'], st['max'])]
+
+        bands = self.layer if self.kind == 'rgb' else [self.layer]
+        stats = []
+        for band in bands:
+            arr = self.store.get(self.datepath, band, window, step)
+            stats.append(wq_stats.cached_stats(self.datepath, band, arr, window, step))
+
+        return utils_plot.stretch_limits(bands, stats=stats)
+
+    def _read(self, window, step):
+        """
+        Masked arrays of the layer on a pixel window
+        """
+
+        if self.kind == 'index':
+            return [wq_tiles.index_block(self.datepath, [self.layer], window, self.store, step)[self.layer]]
+
+        bands = self.layer if self.kind == 'rgb' else [self.layer]
+        return [self.store.read(self.datepath, b, window, step) for b in bands]
+
+    def _colorize(self, arrs):
+
+        valid = np.ones(arrs[0].shape, dtype=bool)
+        for arr in arrs:
+            valid &= ~np.ma.getmaskarray(arr) & np.isfinite(np.ma.getdata(arr))
+
+        rgba = np.zeros(arrs[0].shape + (4,), dtype='uint8')
+        if self.kind == 'rgb':
+            utils_plot.color_composite(*arrs, limits=self.limits, out=rgba[..., :3])
+        else:
+            import matplotlib
+
+            if hasattr(matplotlib, 'colormaps'):
+                cmap = matplotlib.colormaps[self.cmap]
+            else:
+                cmap = matplotlib.cm.get_cmap(self.cmap)
+
+            lo, hi = self.limits[0]
+            scaled = (np.ma.getdata(arrs[0]).astype('float32') - lo) / ((hi - lo) or 1.)
+            rgba[...] = cmap(np.clip(scaled, 0., 1.), bytes=True)
+
+        rgba[..., 3] = np.where(valid, 255, 0)
+
+        return rgba
+
+    def render(self, z, x, y):
+        """
+        RGBA array of a tile, or None if the scene does not cover it
+        """
+
+        south, west, north, east = tile_bounds(z, x, y)
+
+        # centres of the tile pixels, Mercator spaced along the rows
+        n = 2.0 ** z
+        ty = y + (np.arange(tile_size) + 0.5) / tile_size
+        lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ty / n))))
+        lons = west + (np.arange(tile_size) + 0.5) / tile_size * (east - west)
+
+        rows = _nearest(self.lat, lats)
+        cols = _nearest(self.lon, lons)
+        if (rows < 0).all() or (cols < 0).all():
+            return None
+
+        r0, r1 = rows[rows >= 0].min(), rows[rows >= 0].max() + 1
+        c0, c1 = cols[cols >= 0].min(), cols[cols >= 0].max() + 1
+        step = max(1, min((r1 - r0) // tile_size, (c1 - c0) // tile_size))
+
+        arrs = self._read((int(r0), int(r1), int(c0), int(c1)), step)
+
+        # nearest pixel of the decimated window for every tile pixel
+        ri = np.clip((rows - r0) // step, 0, arrs[0].shape[0] - 1)
+        ci = np.clip((cols - c0) // step, 0, arrs[0].shape[1] - 1)
+        arrs = [arr[ri[:, None], ci[None, :]] for arr in arrs]
+
+        rgba = self._colorize(arrs)
+        rgba[rows < 0, :, 3] = 0
+        rgba[:, cols < 0, 3] = 0
+
+        return rgba
+
+    def tile(self, z, x, y):
+        """
+        PNG bytes of a tile (cached), None if the scene does not cover it
+        """
+
+        key = self.key + (z, x, y)
+        png = self.cache.get(key)
+        if png is not None:
+            return png or None
+
+        rgba = self.render(z, x, y)
+        if rgba is None:
+            return self.cache.put(key, b'') or None
+
+        import matplotlib.image
+
+        buf = io.BytesIO()
+        matplotlib.image.imsave(buf, rgba, format='png')
+
+        return self.cache.put(key, buf.getvalue())
+
+class TileOverlay(object):
+    """
+    Draws the visible tiles of a TileSource on an ipyleaflet Map
+
+    The tiles of a new view are rendered on a background thread (see
+    async_tasks); a newer view cancels the rendering of the previous one.
+    """
+
+    def __init__(self, m, source, opacity=1.0):
+
+        from ipyleaflet import LayerGroup
+
+        self.m, self.source, self.opacity = m, source, opacity
+        self.group = LayerGroup(name='{} {}'.format(source.kind, source.layer))
+        self.layers = {}
+
+        m.add_layer(self.group)
+        m.observe(self._on_view, names=['bounds', 'zoom'])
+        self.update()
+
+    def _on_view(self, change):
+
+        self.update()
+
+    def update(self):
+        """
+        Render the tiles of the current view and swap them in
+        """
+
+        import async_tasks
+
+        bounds, z = self.m.bounds, int(round(self.m.zoom))
+        if not bounds:
+            return
+
+        # the view may be on another copy of the world (longitudes + 360 k)
+        (south, west), (north, east) = bounds
+        shift = 360. * np.floor((west + 180.) / 360.)
+        view = ((south, west - shift), (north, east - shift))
+
+        (s_south, s_west), (s_north, s_east) = self.source.bounds
+        if view[0][0] > s_north or view[1][0] < s_south or view[0][1] > s_east or view[1][1] < s_west:
+            tiles = []
+        else:
+            clipped = ((max(view[0][0], s_south), max(view[0][1], s_west)),
+                       (min(view[1][0], s_north), min(view[1][1], s_east)))
+            tiles = [(z, x, y, shift) for x, y in visible_tiles(clipped, z)]
+
+        def load(token):
+            pngs = {}
+            for tile in tiles:
+                token.check()
+                if tile not in self.layers:
+                    pngs[tile] = self.source.tile(*tile[:3])
+            return pngs
+
+        async_tasks.runner.submit('tiles', load, lambda pngs: self._draw(tiles, pngs))
+
+    def _draw(self, tiles, pngs):
+
+        from ipyleaflet import ImageOverlay
+
+        for tile in list(self.layers):
+            if tile not in tiles:
+                self.group.remove_layer(self.layers.pop(tile))
+
+        for tile, png in pngs.items():
+            if png is None:
+                continue
+            z, x, y, shift = tile
+            south, west, north, east = tile_bounds(z, x, y)
+            url = 'data:image/png;base64,' + base64.b64encode(png).decode()
+            layer = ImageOverlay(url=url, bounds=((south, west + shift), (north, east + shift)),
+                                 opacity=self.opacity)
+            self.layers[tile] = layer
+            self.group.add_layer(layer)
+
+    def remove(self):
+        """
+        Take the overlay off the map
+        """
+
+        self.m.unobserve(self._on_view, names=['bounds', 'zoom'])
+        self.m.remove_layer(self.group)
+        self.layers = {}
@@ -0,0 +1,358 @@
+"""
+Client for the IAM and the PaaS orchestrator
+
+Keeps the access token in memory until shortly before it expires and sends
+every request through one pooled requests.Session (keep-alive), with
+timeouts and retries with backoff.
+"""
+import os
+import json
+import time
+import base64
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import instrumentation
+
+iam_url = 'https://iam.extreme-datacloud.eu/token'
+orchestrator_url = 'https://xdc-paas.cloud.ba.infn.it/orchestrator/'
+
+_quiet = threading.local()
+
+def token_expiry(token, response):
+    """
+    Expiry time (epoch) of an access token, from the IAM response
+    (expires_in) or the exp claim of the JWT
+    """
+
+    if 'expires_in' in response:
+        return time.time() + float(response['expires_in'])
+
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, ValueError, KeyError, TypeError):
+        # unknown lifetime, ask again in a minute
+        return time.time() + 60
+
+def _retry(retries, backoff):
+
+    kwargs = dict(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    # only idempotent requests are retried, a POST could create two deployments
+    try:
+        return Retry(allowed_methods=frozenset(['GET', 'HEAD', 'DELETE']), **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=frozenset(['GET', 'HEAD', 'DELETE']), **kwargs)
+
+class OrchestratorClient(object):
+    """
+    Orchestrator client with a cached token and a pooled HTTP session
+
+    Parameters
+    ----------
+    iam_url, orchestrator_url: str
+        Service endpoints (point them to a local mock server for tests)
+    timeout: float or (connect, read) tuple
+        Timeout of every request, seconds
+    retries: int
+        Retries of failed idempotent requests
+    backoff: float
+        Backoff factor between retries, seconds
+    refresh_margin: float
+        Seconds before expiry when the token is refreshed
+    environ: dict
+        Where the refresh token and IAM client credentials are read from
+    pool_size: int
+        Connections kept open, also the most submissions launch_batch has
+        in flight (the notebook allows up to 32)
+    """
+
+    def __init__(self, iam_url=iam_url, orchestrator_url=orchestrator_url, timeout=(5, 30),
+                 retries=3, backoff=0.5, refresh_margin=60, environ=None, verbose=True, pool_size=32):
+
+        self.iam_url = iam_url
+        self.orchestrator_url = orchestrator_url.rstrip('/') + '/'
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.environ = os.environ if environ is None else environ
+        self.verbose = verbose
+
+        # sized once: the job monitor polls through the same session
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=_retry(retries, backoff))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._token = None
+        self._token_url = None
+        self._expiry = 0.
+        self._lock = threading.Lock()
+        self.token_requests = 0
+
+    def _log(self, message):
+
+        # the worker threads of a batch with a progress callback stay quiet
+        if self.verbose and not getattr(_quiet, 'on', False):
+            print(message)
+
+    def access_token(self, force=False):
+        """
+        Access token, refreshed with the refresh token only when it is about
+        to expire
+        """
+        with self._lock:
+            # a token of another IAM (iam_url changed) is not reused
+            if (not force and self._token is not None and self._token_url == self.iam_url and
+                    time.time() < self._expiry - self.refresh_margin):
+                return self._token
+
+            params = {'grant_type': 'refresh_token',
+                      'refresh_token': self.environ['OAUTH2_REFRESH_TOKEN'],
+                      'client_id': self.environ['IAM_CLIENT_ID'],
+                      'client_secret': self.environ['IAM_CLIENT_SECRET'],
+                      'scope': 'openid email profile offline_access fts:submit-transfer'}
+
+            with instrumentation.span('iam_token') as sp:
+                r = self.session.post(self.iam_url, params=params, timeout=self.timeout,
+                                      headers={'Content-Type': 'application/json'})
+                if sp is not None:
+                    sp['status'] = r.status_code
+            self.token_requests += 1
+            self._log("Requesting access token: %s" % r.status_code)
+            r.raise_for_status()
+
+            response = r.json()
+            self._token = response['access_token']
+            self._token_url = self.iam_url
+            self._expiry = token_expiry(self._token, response)
+
+            return self._token
+
+    def request(self, method, path, **kwargs):
+        """
+        Authenticated request to the orchestrator, retried once with a new
+        token if the current one is rejected
+        """
+        url = path if path.startswith('http') else self.orchestrator_url + path
+        kwargs.setdefault('timeout', self.timeout)
+        extra_headers = kwargs.pop('headers', {})
+
+        with instrumentation.span('http', method=method, path=path) as sp:
+            for attempt in range(2):
+                headers = {'Content-Type': 'application/json',
+                           'Authorization': 'Bearer ' + self.access_token(force=attempt > 0)}
+                headers.update(extra_headers)
+                r = self.session.request(method, url, headers=headers, **kwargs)
+                if r.status_code != 401:
+                    break
+            if sp is not None:
+                sp['status'] = r.status_code
+                sp['bytes'] += len(r.content)
+
+        return r
+
+    def launch(self, sat_args, tosca_file='.SAT_DATA_D.yml', cpus=1, mem='8192 MB', tosca=None):
+        """
+        Submit a satellite ingestion deployment, returns its uuid
+        """
+        if tosca is None:
+            with open(tosca_file, 'r') as myfile:
+                tosca = myfile.read()
+
+        sat = json.dumps(sat_args)
+        sat = sat.replace(" ", "")
+
+        data = {"parameters" : {
+                    "cpus" : cpus,
+                    "mem" : mem,
+                    "onedata_provider" : "vm027.pub.cloud.ifca.es",
+                    "onedata_zone" : "https://onezone.cloud.cnaf.infn.it",
+                    "onedata_sat_space" : "XDC_LifeWatch",
+                    "onedata_mount_point": "/mnt/onedata",
+                    "sat_args" : sat,
+                    "region" : sat_args['region'],
+                    "start_date" : sat_args['start_date'],
+                    "end_date" : sat_args['end_date']
+                     },
+                "template" : tosca
+                }
+        self._log('search parameters: {}'.format(data))
+
+        r = self.request('POST', 'deployments/', data=json.dumps(data))
+        self._log("Status code SAT: %s" % r.status_code)
+        r.raise_for_status()
+
+        deployment_id = r.json()['uuid']
+        self._log("Deployment ID: %s" % deployment_id)
+
+        return deployment_id
+
+    def launch_batch(self, jobs, concurrency=4, sizing=None, tosca_file='.SAT_DATA_D.yml', progress=None):
+        """
+        Submit many deployments concurrently
+
+        Parameters
+        ----------
+        jobs: list of dict
+            sat_args of each deployment, see batch_sat_args
+        concurrency: int
+            Submissions in flight at the same time, at most pool_size
+        sizing: callable or None
+            sizing(sat_args) -> (cpus, mem) for each job, default job_size
+        progress: callable or None
+            progress(sat_args, deployment_id, error) is called from the
+            worker threads as each submission ends (deployment_id None if it
+            failed); the client then prints nothing. Without it failures are
+            printed.
+
+        Returns
+        -------
+        List of deployment ids in the order of jobs, None where the
+        submission failed
+        """
+        if sizing is None:
+            sizing = job_size
+
+        with open(tosca_file, 'r') as myfile:
+            tosca = myfile.read()
+
+        # one pooled connection per submission in flight
+        concurrency = max(1, min(concurrency, self.pool_size))
+
+        def submit(sat_args):
+            _quiet.on = progress is not None
+            cpus, mem = sizing(sat_args)
+            deployment_id, error = None, None
+            try:
+                deployment_id = self.launch(sat_args, cpus=cpus, mem=mem, tosca=tosca)
+            except (requests.RequestException, KeyError, ValueError) as e:
+                error = e
+                if progress is None:
+                    print('Submission failed for {} {}-{}: {}'.format(sat_args['region'], sat_args['start_date'],
+                                                                      sat_args['end_date'], e))
+            if progress is not None:
+                progress(sat_args, deployment_id, error)
+            return deployment_id
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(submit, jobs))
+
+    def job_status(self, deployment_id):
+        """
+        Deployment description (dict)
+        """
+        r = self.request('GET', 'deployments/' + deployment_id)
+        self._log("Status code: %s" % r.status_code)
+        r.raise_for_status()
+
+        return r.json()
+
+    def deployments_page(self, page=0, size=20):
+        """
+        One page of deployments, newest first: (list, page info dict)
+        """
+        r = self.request('GET', 'deployments', params={'page': page, 'size': size, 'sort': 'createdAt,desc'})
+        r.raise_for_status()
+        response = r.json()
+
+        return response.get('content', []), response.get('page', {})
+
+    def deployment(self, deployment_id, etag=None):
+        """
+        Conditional GET of a deployment: (deployment dict or None if not
+        modified since etag, new etag)
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        r = self.request('GET', 'deployments/' + deployment_id, headers=headers)
+        if r.status_code == 304:
+            return None, etag
+        r.raise_for_status()
+
+        return r.json(), r.headers.get('ETag')
+
+    def list_deployments(self):
+        """
+        Deployments of the user (first page)
+        """
+        r = self.request('GET', 'deployments')
+        r.raise_for_status()
+
+        return r.json()['content']
+
+    def close(self):
+
+        self.session.close()
+
+def split_dates(start_date, end_date, days):
+    """
+    Split a date range (YYYY-MM-DD strings or dates) into consecutive
+    chunks of at most `days` days
+    """
+
+    if isinstance(start_date, str):
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    if isinstance(end_date, str):
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+
+    chunks = []
+    start = start_date
+    while start <= end_date:
+        end = min(start + datetime.timedelta(days=days - 1), end_date)
+        chunks.append((start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        start = end + datetime.timedelta(days=1)
+
+    return chunks
+
+def batch_sat_args(regions, start_date, end_date, days=30, cloud=100, sat_type='All'):
+    """
+    sat_args of the deployments of a backfill: every region (dict of
+    name -> {"coordinates": ...} as in regions.json) times every date chunk
+    """
+
+    jobs = []
+    for name in sorted(regions):
+        for start, end in split_dates(start_date, end_date, days):
+            jobs.append({"start_date": start,
+                         "end_date": end,
+                         "region": name,
+                         "coordinates": regions[name]["coordinates"],
+                         "cloud": cloud,
+                         "sat_type": sat_type})
+
+    return jobs
+
+def job_size(sat_args):
+    """
+    Resources of an ingestion job (one region) by the days it covers: one
+    core and 8 GB up to a month, two cores and 16 GB for longer chunks
+    """
+
+    start = datetime.datetime.strptime(sat_args['start_date'], '%Y-%m-%d')
+    end = datetime.datetime.strptime(sat_args['end_date'], '%Y-%m-%d')
+    days = (end - start).days + 1
+
+    cpus = 2 if days > 31 else 1
+    mem = 8192 if days <= 31 else 16384
+
+    return cpus, '{} MB'.format(mem)
+
+_client = None
+
+def client():
+    """
+    Shared client used by the notebook
+    """
+
+    global _client
+    if _client is None:
+        _client = OrchestratorClient()
+
+    return _client
@@ -0,0 +1,179 @@
+"""
+On-disk cache of derived products (index rasters and NDWI masks)
+
+Products are written as compressed, chunked NetCDF files in a .wq_cache
+folder inside the region folder, next to the scenes. Each file records the
+formula version (the index signature for indices, see wq_indices) and the
+modification time of its source scene and is recomputed when either of
+them changes. Only the whole scene and region box products go to disk, the
+windows of drawn polygons are kept in the band store (persist=False), so
+the folder does not grow with every shape or zoom.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+from netCDF4 import Dataset
+
+import band_store
+import utils_plot
+import wq_indices
+
+#Folder (inside the region folder) holding the products
+cache_folder = '.wq_cache'
+
+def product_path(datepath, product, window=None, step=1):
+    """
+    Cache file of a product of a scene, for a read window and step
+    """
+
+    region_path, scene = os.path.split(datepath)
+    stem = os.path.splitext(scene)[0]
+    key = hashlib.md5(repr((window, step)).encode()).hexdigest()[:8]
+    name = '{}.{}.{}.nc'.format(stem, product.replace(' ', '_'), key)
+
+    return os.path.join(region_path, cache_folder, name)
+
+def _formula(product):
+    """
+    Signature of the definition of an index product, '' for the others
+    """
+
+    index = wq_indices.registry.get(product)
+
+    return index.signature() if index is not None else ''
+
+def _is_valid(nc, datepath, product):
+
+    return (nc.getncattr('formula_version') == utils_plot.formula_version and
+            nc.getncattr('formula') == _formula(product) and
+            nc.getncattr('source_mtime') == os.path.getmtime(datepath))
+
+def load_product(datepath, product, window=None, step=1):
+    """
+    Cached product as a masked array, or None if missing or out of date
+    """
+
+    path = product_path(datepath, product, window, step)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with Dataset(path, 'r') as nc:
+            if not _is_valid(nc, datepath, product):
+                return None
+            arr = nc.variables['data'][:]
+    except (OSError, AttributeError, KeyError):
+        return None
+
+    if product == 'NDWI mask':
+        return np.asarray(arr).astype(bool)
+
+    # NaN only, like a freshly computed index (inf values stay valid)
+    data = np.ma.filled(arr, np.nan)
+
+    return np.ma.masked_array(data, mask=np.isnan(data), copy=False)
+
+def save_product(datepath, product, arr, window=None, step=1):
+    """
+    Write a product to the cache, silently skipping read-only folders
+    """
+
+    path = product_path(datepath, product, window, step)
+    tmp_path = None
+    chunks = [min(256, n) for n in arr.shape]
+
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # one temporary file per writer, parallel workers may save the same product
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                        dir=os.path.dirname(path))
+        os.close(fd)
+
+        with Dataset(tmp_path, 'w', format='NETCDF4_CLASSIC') as nc:
+            nc.createDimension('y', arr.shape[0])
+            nc.createDimension('x', arr.shape[1])
+            if product == 'NDWI mask':
+                var = nc.createVariable('data', 'i1', ('y', 'x'), zlib=True, chunksizes=chunks)
+                var[:] = np.asarray(arr, dtype='i1')
+            else:
+                var = nc.createVariable('data', 'f4', ('y', 'x'), zlib=True, chunksizes=chunks,
+                                        fill_value=np.float32(np.nan))
+                var[:] = np.ma.filled(np.ma.asarray(arr, dtype='float32'), np.nan)
+            nc.setncattr('scene', os.path.basename(datepath))
+            nc.setncattr('product', product)
+            nc.setncattr('formula_version', utils_plot.formula_version)
+            nc.setncattr('formula', _formula(product))
+            nc.setncattr('source_mtime', os.path.getmtime(datepath))
+
+        # readers never see a half written file (mkstemp makes it private)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    except (OSError, RuntimeError):
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def cached_water_mask(datepath, store=None, window=None, step=1, persist=True):
+    """
+    Non-water mask of a scene, from memory, the disk cache or computed
+
+    With persist=False the disk cache is neither read nor written.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    key = (datepath, 'NDWI mask', window, step)
+    mask = store.lookup(key)
+    if mask is not None:
+        return mask
+
+    mask = load_product(datepath, 'NDWI mask', window, step) if persist else None
+    if mask is None:
+        mask = utils_plot.scene_water_mask(datepath, store, window, step)
+        if persist:
+            save_product(datepath, 'NDWI mask', mask, window, step)
+        return mask
+
+    return store.put(key, mask)
+
+def cached_index(datepath, index, store=None, window=None, step=1, persist=True):
+    """
+    Index raster of a scene, read from the cache when it is up to date
+
+    Otherwise the index is computed (reusing a cached NDWI mask) and stored,
+    on disk only if persist (whole scene and region box windows).
+    """
+
+    if store is None:
+        store = band_store.store
+
+    key = (datepath, 'index ' + index, window, step)
+    arr = store.lookup(key)
+    if arr is not None:
+        return arr
+
+    arr = load_product(datepath, index, window, step) if persist else None
+    if arr is None:
+        mask = cached_water_mask(datepath, store, window, step, persist)
+        arr = utils_plot.compute_index(datepath, index, store, window, step, mask)
+        if persist:
+            save_product(datepath, index, arr, window, step)
+
+    return store.put(key, arr)
+
+def clear(region_path):
+    """
+    Remove every cached product of a region
+    """
+
+    folder = os.path.join(region_path, cache_folder)
+    if not os.path.isdir(folder):
+        return
+
+    for f in os.listdir(folder):
+        os.remove(os.path.join(folder, f))
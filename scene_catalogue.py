@@ -0,0 +1,185 @@
+"""
+Persistent scene catalogue (SQLite)
+
+Keeps region, satellite, acquisition date, path, size, bands, extent and
+cloud cover of every scene, so the notebook does not list and parse the
+Onedata folders on every region change. The catalogue is updated
+incrementally: a region folder is only listed again when its mtime changes
+and a scene is only opened again when its own mtime changes.
+"""
+import os
+import sqlite3
+import datetime
+
+import numpy as np
+from netCDF4 import Dataset
+
+import utils_plot
+
+#Kept on local disk, SQLite locking does not work on the FUSE mount
+db_path = os.path.join(os.path.expanduser('~'), '.wq_sat', 'catalogue.sqlite')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS regions (
+    region TEXT PRIMARY KEY,
+    path TEXT,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS scenes (
+    path TEXT PRIMARY KEY,
+    region TEXT,
+    file TEXT,
+    satellite TEXT,
+    date TEXT,
+    size INTEGER,
+    mtime REAL,
+    bands TEXT,
+    W REAL, S REAL, E REAL, N REAL,
+    cloud REAL
+);
+CREATE INDEX IF NOT EXISTS scenes_region_date ON scenes (region, date);
+"""
+
+def connect(path=None):
+    """
+    Open (and create if needed) the catalogue database
+    """
+
+    if path is None:
+        path = db_path
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    con.executescript(_schema)
+
+    return con
+
+def scene_metadata(datepath):
+    """
+    Bands, extent (W, S, E, N) and cloud cover of a scene file
+    """
+
+    with Dataset(datepath, 'r') as dataset:
+        bands = [name for name, var in dataset.variables.items() if var.ndim == 2]
+
+        extent = (None, None, None, None)
+        lat = utils_plot.coordinate_axis(dataset, ('lat', 'latitude'), 0)
+        lon = utils_plot.coordinate_axis(dataset, ('lon', 'longitude'), 1)
+        if lat is not None and lon is not None:
+            extent = (float(np.min(lon)), float(np.min(lat)), float(np.max(lon)), float(np.max(lat)))
+
+        cloud = None
+        for attr in dataset.ncattrs():
+            if 'cloud' in attr.lower():
+                try:
+                    cloud = float(dataset.getncattr(attr))
+                except (TypeError, ValueError):
+                    pass
+                break
+
+    return bands, extent, cloud
+
+def update_region(con, region, region_path, force=False):
+    """
+    Bring the scenes of a region up to date, returns the number of scenes
+    (re)read
+
+    The folder is not listed if its mtime did not change (files added or
+    removed); use force=True to check scenes rewritten in place.
+    """
+
+    mtime = os.path.getmtime(region_path)
+    row = con.execute('SELECT mtime FROM regions WHERE region = ?', (region,)).fetchone()
+    if not force and row is not None and row['mtime'] == mtime:
+        return 0
+
+    known = {}
+    for r in con.execute('SELECT path, mtime FROM scenes WHERE region = ?', (region,)):
+        known[r['path']] = r['mtime']
+
+    updated = 0
+    present = set()
+    for f in os.listdir(region_path):
+        if not (f.startswith('LC') or f.startswith('S2')):
+            continue
+
+        datepath = os.path.join(region_path, f)
+        present.add(datepath)
+        st = os.stat(datepath)
+        if known.get(datepath) == st.st_mtime:
+            continue
+
+        try:
+            bands, extent, cloud = scene_metadata(datepath)
+        except (OSError, RuntimeError):
+            bands, extent, cloud = [], (None, None, None, None), None
+
+        satellite = 'Landsat8' if utils_plot.scene_sensor(f) == 'landsat' else 'Sentinel2'
+        con.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (datepath, region, f, satellite, utils_plot.scene_date(f).strftime('%Y-%m-%d'),
+                     st.st_size, st.st_mtime, ','.join(bands)) + tuple(extent) + (cloud,))
+        updated += 1
+
+    # scenes removed from the folder
+    for datepath in set(known) - present:
+        con.execute('DELETE FROM scenes WHERE path = ?', (datepath,))
+
+    con.execute('INSERT OR REPLACE INTO regions VALUES (?, ?, ?)', (region, region_path, mtime))
+    con.commit()
+
+    return updated
+
+def query(con, region=None, start=None, end=None, satellite=None, max_cloud=None):
+    """
+    Scenes matching the filters, sorted by date
+
+    Parameters
+    ----------
+    start, end: datetime.date or str (YYYY-MM-DD)
+    satellite: 'Landsat8', 'Sentinel2' or None/'All'
+    max_cloud: float, scenes without cloud information are kept
+    """
+
+    sql = 'SELECT * FROM scenes WHERE 1 = 1'
+    args = []
+
+    if region is not None:
+        sql += ' AND region = ?'
+        args.append(region)
+    if start is not None:
+        sql += ' AND date >= ?'
+        args.append(str(start)[:10])
+    if end is not None:
+        sql += ' AND date <= ?'
+        args.append(str(end)[:10])
+    if satellite not in (None, 'All'):
+        sql += ' AND satellite = ?'
+        args.append(satellite)
+    if max_cloud is not None:
+        sql += ' AND (cloud IS NULL OR cloud <= ?)'
+        args.append(max_cloud)
+
+    return con.execute(sql + ' ORDER BY date, file', args).fetchall()
+
+def region_scenes(region, region_path, satellite=None, max_cloud=None, con=None):
+    """
+    (date, file name) of the scenes of a region, like utils_plot.region_scenes
+    but served from the catalogue
+    """
+
+    own = con is None
+    if own:
+        con = connect()
+
+    try:
+        update_region(con, region, region_path)
+        rows = query(con, region, satellite=satellite, max_cloud=max_cloud)
+    finally:
+        if own:
+            con.close()
+
+    return [(datetime.datetime.strptime(r['date'], '%Y-%m-%d'), r['file']) for r in rows]
@@ -0,0 +1,62 @@
+"""
+Percentiles of wq_stats against numpy
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wq_stats
+
+def reflectance(shape=(1000, 1000), seed=0):
+    """
+    Reflectance-like band (0.01-0.3) with a few outlier pixels and NaN
+    """
+
+    rng = np.random.default_rng(seed)
+    arr = rng.uniform(0.01, 0.3, shape).astype('float32')
+    arr[0, 0], arr[1, 1], arr[2, 2] = 1e4, -50., np.nan
+
+    return arr
+
+def test_array_stats_outliers():
+
+    arr = reflectance()
+    valid = arr[np.isfinite(arr)]
+    st = wq_stats.array_stats(arr, (2.5, 97.5))
+
+    assert np.isclose(st[2.5], np.percentile(valid, 2.5))
+    assert np.isclose(st[97.5], np.percentile(valid, 97.5))
+    assert st['max'] == 1e4 and st['count'] == valid.size
+
+def test_running_stats_outliers():
+
+    arr = reflectance()
+    valid = arr[np.isfinite(arr)]
+
+    stats = wq_stats.RunningStats()
+    for r0 in range(0, arr.shape[0], 100):
+        stats.update(arr[r0:r0 + 100])
+
+    # a uniform sample of 65536 of the 10^6 pixels, well within half a percent in rank
+    for q in (2.5, 50, 97.5):
+        rank = (valid < stats.percentile(q)).mean() * 100
+        assert abs(rank - q) < 0.5
+
+def test_running_stats_merge():
+
+    arr = reflectance((300, 200))
+    valid = arr[np.isfinite(arr)]
+
+    a, b = wq_stats.RunningStats(), wq_stats.RunningStats()
+    a.update(arr[:100])
+    b.update(arr[100:])
+    a.merge(b)
+
+    # every pixel fits in the sample: exact
+    assert a.count == valid.size
+    assert np.isclose(a.percentile(97.5), np.percentile(valid, 97.5))
+    assert np.isclose(a.mean, valid.astype('float64').mean())
+    assert np.isclose(a.std, valid.astype('float64').std())
@@ -1,96 +1,360 @@
 import os
+import datetime
 import numpy as np
-from netCDF4 import Dataset
 
-def load_bands(datepath, band_list):
+import band_store
+import wq_stats
+import instrumentation
+import geo_index
+import wq_indices
+
+#Longest side (pixels) of the previews drawn in the notebook
+preview_pixels = 1024
+
+#Rows processed at a time by the fused band math
+chunk_rows = 512
+
+@instrumentation.timed()
+def load_bands(datepath, band_list, store=None, window=None, step=1):
     """
     Retrieve a dict of band arrays from a date path
+
+    Bands are served from the band store, so only the first request of a
+    band reads the file.
     """
     
-    arr_band = Dataset(datepath, 'r', format='NETCDF4_CLASSIC')
+    if store is None:
+        store = band_store.store
     
     band_dict = {}
     for band in band_list:
         b = band_list[band]
         try:
-            band_dict[b] = arr_band.variables[b][:] # band array
-        except:
+            band_dict[b] = store.get(datepath, b, window, step) # band array
+        except KeyError:
             continue
         
     return band_dict
 
-def color_composite(b0, b1, b2, clip=True):
+def coordinate_axis(dataset, names, axis):
+    """
+    1D coordinate values along one raster axis (0: rows, 1: columns)
+    """
+    
+    for n in names:
+        if n in dataset.variables:
+            values = np.asarray(dataset.variables[n][:])
+            if values.ndim == 2:
+                values = values[:, 0] if axis == 0 else values[0, :]
+            return values
+        
+    return None
+
+def read_window(datepath, coordinates, store=None):
+    """
+    Pixel window (row_start, row_stop, col_start, col_stop) of a scene
+    covering the W/S/E/N box of a region
+
+    Returns None (whole scene) if the scene has no lat/lon grid or the box
+    does not overlap it.
+    """
+    
+    if coordinates is None:
+        return None
+    
+    return geo_index.polygon_window(datepath, geo_index.box_polygon(coordinates), store)
+
+def display_step(shape, window=None, max_pixels=None):
+    """
+    Decimation step so that a (windowed) raster fits the display resolution
+
+    A small window (zoomed in) gets step 1, i.e. full resolution.
+    """
+    
+    if max_pixels is None:
+        max_pixels = preview_pixels
+    
+    if window is not None:
+        shape = (window[1] - window[0], window[3] - window[2])
+    
+    return max(1, int(np.ceil(max(shape) / float(max_pixels))))
+
+def scene_shape(datepath, store=None):
+    """
+    Raster shape of a scene (all its bands share the same grid)
+    """
+    
+    if store is None:
+        store = band_store.store
+    
+    for var in store.dataset(datepath).variables.values():
+        if var.ndim == 2:
+            return var.shape
+
+def preview_read(datepath, coordinates=None, max_pixels=None, store=None, polygon=None):
+    """
+    Window and decimation step used to preview a scene in the notebook,
+    cropped to the W/S/E/N box or to the bounding box of a polygon
+    """
+    
+    if polygon is not None:
+        window = geo_index.polygon_window(datepath, polygon, store)
+    else:
+        window = read_window(datepath, coordinates, store)
+    step = display_step(scene_shape(datepath, store), window, max_pixels)
+    
+    return window, step
+
+#Bands read by each water quality index, the NDWI bands of the water mask
+#first (kept up to date by wq_indices.register)
+index_bands = wq_indices.index_bands
+
+#Version of the NDWI water mask, bump it when it changes (the index
+#formulas are versioned by wq_indices signatures)
+formula_version = 1
+
+def scene_sensor(filename):
+    """
+    Sensor of a scene from its file name (Landsat 8: LC*, Sentinel-2: S2*)
+    """
+    
+    filename = os.path.basename(filename)
+    if filename.startswith('LC'):
+        return 'landsat'
+    elif filename.startswith('S2'):
+        return 'sentinel'
+    
+    raise ValueError('Unknown satellite for scene {}'.format(filename))
+
+def scene_date(filename):
+    """
+    Acquisition date of a scene from its file name
+    (Landsat 8: YYYYDDD at [9:16], Sentinel-2: YYYYMMDD at [11:19])
+    """
+    
+    f = os.path.basename(filename)
+    if f.startswith('LC'):
+        return datetime.datetime.strptime('{} {}'.format(f[9:13], f[13:16]), '%Y %j')
+    elif f.startswith('S2'):
+        return datetime.datetime.strptime(f[11:19], '%Y%m%d')
+
+def region_scenes(region_path, satellite=None, start=None, end=None):
+    """
+    List of (date, file name) of the scenes of a region, sorted by date
+
+    Parameters
+    ----------
+    satellite: str or None
+        'Landsat8' or 'Sentinel2' to keep only one of them
+    start, end: datetime or None
+        Date range of the scenes
+    """
+    
+    sensors = {'Landsat8': 'landsat', 'Sentinel2': 'sentinel'}
+    
+    scenes = []
+    for f in os.listdir(region_path):
+        if not (f.startswith('LC') or f.startswith('S2')):
+            continue
+        if satellite in sensors and scene_sensor(f) != sensors[satellite]:
+            continue
+        date = scene_date(f)
+        if (start is not None and date < start) or (end is not None and date > end):
+            continue
+        scenes.append((date, f))
+    
+    return sorted(scenes)
+
+def load_index_bands(datepath, index, store=None, window=None, step=1):
+    """
+    Retrieve only the bands needed to compute an index
+    """
+    
+    if store is None:
+        store = band_store.store
+    
+    bands = index_bands[scene_sensor(datepath)][index]
+    
+    return {b: store.get(datepath, b, window, step) for b in bands}
+
+def compute_index(datepath, index, store=None, window=None, step=1, mask=None):
+    """
+    Load the bands of an index on demand and compute it
+    """
+    
+    with instrumentation.span('compute_index', index=index, step=step):
+        band_dict = load_index_bands(datepath, index, store, window, step)
+        if mask is None:
+            mask = scene_water_mask(datepath, store, window, step)
+        
+        return wq_indices.compute(band_dict, scene_sensor(datepath), [index], mask)[index]
+
+def stretch_limits(bands, clip=True, stats=None):
+    """
+    (low, high) stretch limits of each band
+
+    The 2.5/97.5 percentiles if clip, else min/max. Precomputed statistics
+    (see wq_stats) can be given to avoid another pass over the bands.
+    """
+    
+    if stats is None:
+        stats = [wq_stats.array_stats(b, (2.5, 97.5)) for b in bands]
+    
+    if clip:
+        return [(st[2.5], st[97.5]) for st in stats]
+    
+    return [(st['min'], st['max']) for st in stats]
+
+@instrumentation.timed()
+def color_composite(b0, b1, b2, clip=True, limits=None, stretch='linear', gamma=1.,
+                    common_scale=True, out=None, rows=None):
     """
     Compose an image from three different bands
 
+    The image is written block by block straight into one HxWx3 uint8
+    buffer, only a block of one band is held as float at a time.
+
     Parameters
     ----------
     clip: bool
         Clip very low/high pixels to make the image brighter (another possibility
         would be to take the logarithm)
+    limits: list of (low, high) or None
+        Stretch limits of each band, see stretch_limits
+    stretch: str
+        'linear', 'log' or 'gamma'
+    gamma: float
+        Gamma of the 'gamma' stretch
+    common_scale: bool
+        Scale the three bands by the highest of their limits (keeps the
+        colour balance), otherwise stretch each band to its own limits
+    out: uint8 array or None
+        Preallocated HxWx3 buffer
     """
-    if clip:
-        b0 = np.clip(b0, np.percentile(b0, 2.5), np.percentile(b0, 97.5))
-        b1 = np.clip(b1, np.percentile(b1, 2.5), np.percentile(b1, 97.5))
-        b2 = np.clip(b2, np.percentile(b2, 2.5), np.percentile(b2, 97.5))
-
-    im = np.array([b0, b1, b2])
-    im = im * 255 / np.amax(im)
-    im = np.moveaxis(im, 0, -1)
-    return im.astype('uint8')
-
-def landsat_wq(band_dict, index):
+    
+    bands = (b0, b1, b2)
+    if rows is None:
+        rows = chunk_rows
+    if limits is None:
+        limits = stretch_limits(bands, clip)
+    if out is None:
+        out = np.empty(b0.shape + (3,), dtype='uint8')
+    
+    top = max(hi for lo, hi in limits)
+    buf = np.empty((min(rows, b0.shape[0]), b0.shape[1]), dtype='float32')
+    
+    for k, (band, (lo, hi)) in enumerate(zip(bands, limits)):
+        if common_scale:
+            offset, scale = 0., (1. / top if top > 0 else 0.)
+        else:
+            offset, scale = lo, (1. / (hi - lo) if hi > lo else 0.)
         
-    #Water mask
-    ndwi = (band_dict['SRB3'] - band_dict['SRB5']) / (band_dict['SRB3'] + band_dict['SRB5'])
-    ndwi[ndwi <=0] = np.nan #replace 0's with Nan's
-    ndwi = np.ma.masked_where(condition=np.isnan(ndwi), a=ndwi)
+        for r0 in range(0, b0.shape[0], rows):
+            block = band[r0:r0 + rows]
+            tmp = buf[:block.shape[0]]
             
-    if index == 'chl':
-        
-        chl = (band_dict['SRB5'] - band_dict['SRB4']) / (band_dict['SRB2'] + band_dict['SRB3'])
-        chl[ndwi.mask] = np.nan
-        chl = np.ma.masked_where(condition=np.isnan(chl), a=chl)
-        
-        return chl
+            np.copyto(tmp, _data(block), casting='unsafe')
+            np.clip(tmp, lo, hi, out=tmp)
+            tmp -= offset
+            tmp *= scale
+            np.clip(tmp, 0., 1., out=tmp)
+            
+            if stretch == 'log':
+                # log1p(99 x) / log(100) maps [0, 1] onto [0, 1]
+                tmp *= 99.
+                np.log1p(tmp, out=tmp)
+                tmp /= np.log(100.)
+            elif stretch == 'gamma':
+                np.power(tmp, 1. / gamma, out=tmp)
+            
+            tmp *= 255.
+            # masked and NaN pixels are drawn black
+            invalid = np.isnan(tmp)
+            if np.ma.getmask(block) is not np.ma.nomask:
+                invalid |= block.mask
+            tmp[invalid] = 0.
+            
+            np.copyto(out[r0:r0 + rows, :, k], tmp, casting='unsafe')
+            
+    return out
+
+def _data(arr):
     
-    elif index == 'Temp':
-        
-        Temp = band_dict['SRB10']
-        Temp[ndwi.mask] = np.nan
-        Temp = np.ma.masked_where(condition=np.isnan(Temp), a=Temp)
-        
-        return Temp
+    return np.ma.getdata(arr)
+
+def ndwi_mask(green, nir, rows=None):
+    """
+    Boolean mask of the non-water pixels (NDWI <= 0, NaN or masked)
+
+    NDWI = (Green - NIR) / (Green + NIR) is evaluated in a single pass over
+    blocks of rows, reusing two block-sized buffers, so no full size
+    temporaries are created.
+    """
     
-    elif index == 'Turb':
-        
-        # NDTI = Red - Green / Red + Green
-        ndti = (band_dict['SRB4'] - band_dict['SRB3']) / (band_dict['SRB4'] + band_dict['SRB3'])
-        ndti[ndwi.mask] = np.nan
-        ndti = np.ma.masked_where(condition=np.isnan(ndti), a=ndti)
-        
-        return ndti
+    if rows is None:
+        rows = chunk_rows
     
-def sentinel_wq(band_dict, index):
-        
-    # NDWI = Green - NIR / Green + NIR -> B3 - B8 / B3 + B8
-    ndwi = (band_dict['B3'] - band_dict['B8']) / (band_dict['B3'] + band_dict['B8'])
-    ndwi[ndwi <=0] = np.nan #replace 0's with Nan's
-    ndwi = np.ma.masked_where(condition=np.isnan(ndwi), a=ndwi)
+    g, n = _data(green), _data(nir)
+    mask = np.empty(g.shape, dtype=bool)
     
-    if index == 'chl':
-        
-        chl = (band_dict['SRB8A'] - band_dict['B4']) / (band_dict['B2'] + band_dict['B3'])
-        chl[ndwi.mask] = np.nan
-        chl = np.ma.masked_where(condition=np.isnan(chl), a=chl)
-        
-        return chl
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r0 in range(0, g.shape[0], rows):
+            r1 = min(r0 + rows, g.shape[0])
+            num = np.subtract(g[r0:r1], n[r0:r1], dtype='float32')
+            den = np.add(g[r0:r1], n[r0:r1], dtype='float32')
+            np.divide(num, den, out=num)
+            np.less_equal(num, 0, out=mask[r0:r1])
+            mask[r0:r1] |= np.isnan(num)
     
-    elif index == 'Turb':
-        
-        # NDTI = Red - Green / Red + Green
-        ndti = (band_dict['B4'] - band_dict['B3']) / (band_dict['B4'] + band_dict['B3'])
-        ndti[ndwi.mask] = np.nan
-        ndti = np.ma.masked_where(condition=np.isnan(ndti), a=ndti)
+    for b in (green, nir):
+        if np.ma.getmask(b) is not np.ma.nomask:
+            mask |= b.mask
+    
+    return mask
+
+def scene_water_mask(datepath, store=None, window=None, step=1):
+    """
+    Non-water mask of a scene, computed once and kept in the band store
+    """
+    
+    if store is None:
+        store = band_store.store
+    
+    key = (datepath, 'NDWI mask', window, step)
+    mask = store.lookup(key)
+    if mask is None:
+        green, nir = index_bands[scene_sensor(datepath)]['NDWI']
+        mask = ndwi_mask(store.get(datepath, green, window, step),
+                         store.get(datepath, nir, window, step))
+        mask = store.put(key, mask)
         
-        return ndti
\ No newline at end of file
+    return mask
+
+def apply_mask(arr, mask, *bands):
+    """
+    Mask an index outside the water (and where it is NaN or any of its
+    bands is masked) without copying or modifying its data
+    """
+    
+    full_mask = mask | np.isnan(arr)
+    for b in bands:
+        if np.ma.getmask(b) is not np.ma.nomask:
+            full_mask |= b.mask
+            
+    return np.ma.masked_array(_data(arr), mask=full_mask, copy=False)
+
+@instrumentation.timed()
+def landsat_wq(band_dict, index, mask=None):
+    """
+    Water quality index of Landsat 8 bands, see wq_indices
+    """
+    
+    return wq_indices.compute(band_dict, 'landsat', [index], mask)[index]
+
+@instrumentation.timed()
+def sentinel_wq(band_dict, index, mask=None):
+    """
+    Water quality index of Sentinel-2 bands, see wq_indices
+    """
+    
+    return wq_indices.compute(band_dict, 'sentinel', [index], mask)[index]
@@ -0,0 +1,238 @@
+"""
+Temporal composites of the scenes of a region
+
+Stacks a band or index over N co-registered scenes (same sensor, same
+grid) and reduces it per pixel (median, mean, max, min or a percentile)
+over the water pixels of each date, which fills the cloud holes of the
+single dates. The raster is processed block by block on a process pool
+and every block holds the N dates of a layer within the memory budget.
+"""
+import os
+import warnings
+
+import numpy as np
+from netCDF4 import Dataset
+
+import band_store
+import utils_plot
+import wq_indices
+import wq_tiles
+import wq_parallel
+
+#Reductions along the time axis, 'p<q>' (e.g. 'p90') for a percentile
+methods = {'median': np.nanmedian,
+           'mean': np.nanmean,
+           'max': np.nanmax,
+           'min': np.nanmin}
+
+def reducer(method):
+    """
+    Function reducing a (time, y, x) stack with NaN gaps along time
+    """
+
+    if method in methods:
+        return methods[method]
+
+    if method.startswith('p'):
+        q = float(method[1:])
+        if 0 <= q <= 100:
+            return lambda stack, axis: np.nanpercentile(stack, q, axis=axis)
+
+    raise ValueError('Unknown composite method {}'.format(method))
+
+def layer_block(datepath, layers, window, store=None, step=1):
+    """
+    Bands or indices of one block of a scene, masked outside the water
+
+    Returns a dict of masked arrays, one per layer.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    sensor = utils_plot.scene_sensor(datepath)
+    indices = [l for l in layers if l in utils_plot.index_bands[sensor]]
+
+    bands = set(utils_plot.index_bands[sensor]['NDWI'])
+    for layer in layers:
+        bands.update(utils_plot.index_bands[sensor].get(layer, [layer]))
+
+    band_dict = {b: store.read(datepath, b, window, step) for b in bands}
+
+    green, nir = utils_plot.index_bands[sensor]['NDWI']
+    mask = utils_plot.ndwi_mask(band_dict[green], band_dict[nir])
+
+    results = wq_indices.compute(band_dict, sensor, indices, mask)
+    for layer in layers:
+        if layer not in indices:
+            results[layer] = utils_plot.apply_mask(band_dict[layer], mask, band_dict[layer])
+
+    return results
+
+def composite_block(datepaths, layers, window, method='median', step=1, store=None):
+    """
+    Composite of each layer over the scenes, on one block
+
+    Returns a dict with the composite of each layer and the number of valid
+    dates of each pixel ('<layer>_count').
+    """
+
+    if store is None:
+        store = band_store.store
+
+    reduce = reducer(method)
+
+    r0, r1, c0, c1 = window
+    shape = (len(range(r0, r1, step)), len(range(c0, c1, step)))
+    stacks = dict((l, np.empty((len(datepaths),) + shape, dtype='float32')) for l in layers)
+
+    for n, datepath in enumerate(datepaths):
+        results = layer_block(datepath, layers, window, store, step)
+        for l in layers:
+            np.copyto(stacks[l][n], np.ma.filled(results[l].astype('float32'), np.nan))
+
+    composites = {}
+    for l in layers:
+        # pixels never seen as water stay NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            composites[l] = reduce(stacks[l], axis=0).astype('float32')
+        composites['{}_count'.format(l)] = np.count_nonzero(~np.isnan(stacks[l]), axis=0).astype('float32')
+        del stacks[l]
+
+    return composites
+
+#Store of the worker processes, keeping every scene of the stack open
+_store = None
+
+def _composite_job(args):
+
+    global _store
+
+    datepaths, layers, window, method, step = args
+    if _store is None or _store.max_datasets < len(datepaths):
+        _store = band_store.BandStore(max_datasets=len(datepaths))
+
+    return window, composite_block(datepaths, layers, window, method, step, _store)
+
+def region_composite(region_path, layers, method='median', satellite=None, start=None, end=None,
+                     out_path=None, scenes=None, workers=None, max_bytes=None):
+    """
+    Per-pixel temporal composite of bands or indices over a region folder
+
+    Parameters
+    ----------
+    region_path: str
+        Region folder (e.g. paths['region_path'] in the notebook)
+    layers: list
+        Indices (e.g. ['chl', 'Turb']) and/or band variables to composite
+    method: str
+        'median', 'mean', 'max', 'min' or a percentile such as 'p90'
+    satellite: str or None
+        'Landsat8' or 'Sentinel2'; the scenes must share one sensor and grid
+    start, end: datetime or None
+        Date range of the scenes
+    out_path: str or None
+        NetCDF file to write, the composites are returned in memory if None
+    scenes: list or None
+        File names to use instead of the satellite/start/end selection
+    workers: int
+        Processes computing blocks (default: every core)
+    max_bytes: int
+        Memory budget of the stack of one layer in a block (all dates)
+
+    Returns
+    -------
+    out_path, or a dict of masked arrays with the composite of each layer
+    and its count of valid dates ('<layer>_count')
+    """
+
+    if workers is None:
+        workers = wq_parallel.default_workers()
+    if max_bytes is None:
+        max_bytes = wq_tiles.block_bytes
+    if scenes is None:
+        scenes = [f for date, f in utils_plot.region_scenes(region_path, satellite, start, end)]
+    if not scenes:
+        raise ValueError('No scenes to composite in {}'.format(region_path))
+
+    layers = list(layers)
+    datepaths = [os.path.join(region_path, f) for f in scenes]
+    sensors = set(utils_plot.scene_sensor(f) for f in scenes)
+    if len(sensors) > 1:
+        raise ValueError('Scenes of both satellites, choose one (satellite=...)')
+    sensor = sensors.pop()
+
+    with Dataset(datepaths[0]) as dataset:
+        green = utils_plot.index_bands[sensor]['NDWI'][0]
+        var = dataset.variables[green]
+        shape = var.shape
+        for layer in layers:
+            if layer not in utils_plot.index_bands[sensor] and layer not in dataset.variables:
+                raise ValueError('{} is not available for {}'.format(layer, sensor))
+        # every date of a layer in a block shares the budget
+        block = wq_tiles.block_shape(var, max(1, max_bytes // len(datepaths)))
+
+    for datepath in datepaths[1:]:
+        with Dataset(datepath) as dataset:
+            if dataset.variables[green].shape != shape:
+                raise ValueError('{} is not on the grid of {}'.format(datepath, scenes[0]))
+
+    names = []
+    for l in layers:
+        names += [l, '{}_count'.format(l)]
+
+    if out_path is not None:
+        with Dataset(datepaths[0]) as dataset:
+            out = wq_tiles.create_netcdf(out_path, dataset, shape, block, names)
+        out.setncattr('method', method)
+        out.setncattr('scenes', ','.join(scenes))
+    else:
+        out = dict((name, np.empty(shape, dtype='float32')) for name in names)
+
+    jobs = ((datepaths, layers, window, method, 1) for window in wq_tiles.raster_blocks(shape, block))
+
+    try:
+        with wq_parallel.process_pool(workers) as executor:
+            for window, results in wq_tiles.imap_ordered(executor, _composite_job, jobs, 2 * workers):
+                if out_path is not None:
+                    wq_tiles.write_block(out, names, window, results)
+                else:
+                    r0, r1, c0, c1 = window
+                    for name in names:
+                        out[name][r0:r1, c0:c1] = results[name]
+    finally:
+        if out_path is not None:
+            out.close()
+
+    if out_path is not None:
+        return out_path
+
+    return dict((name, np.ma.masked_invalid(arr, copy=False)) for name, arr in out.items())
+
+def monthly_composites(region_path, layers=('chl', 'Turb'), method='median', satellite='Sentinel2',
+                       out_dir=None, workers=None, max_bytes=None):
+    """
+    One composite per month of a region, written to out_dir as
+    <region>_<YYYY-MM>_<method>.nc
+
+    Returns a list of (month, output path) sorted by month.
+    """
+
+    if out_dir is None:
+        out_dir = region_path
+
+    months = {}
+    for date, f in utils_plot.region_scenes(region_path, satellite):
+        months.setdefault(date.strftime('%Y-%m'), []).append(f)
+
+    region = os.path.basename(os.path.normpath(region_path))
+
+    outputs = []
+    for month in sorted(months):
+        out_path = os.path.join(out_dir, '{}_{}_{}.nc'.format(region, month, method))
+        region_composite(region_path, layers, method, out_path=out_path, scenes=months[month],
+                         workers=workers, max_bytes=max_bytes)
+        outputs.append((month, out_path))
+
+    return outputs
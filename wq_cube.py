@@ -0,0 +1,340 @@
+"""
+Pixel time series cube of a region
+
+Stacks the water quality indices of the scenes of a region into a
+(time, y, x) NetCDF cube, chunked for reading pixel histories, and
+appends the new scenes when it is built again (or builds it anew when an
+index formula changed). The operators (rolling mean, linear trend, z-score
+anomalies) go over the cube one spatial block at a time with every date of
+the block in memory, vectorized over the pixels of the block.
+"""
+import os
+
+import numpy as np
+from netCDF4 import Dataset, date2num, num2date
+
+import band_store
+import utils_plot
+import wq_tiles
+import wq_indices
+import geo_index
+
+#Units of the time axis
+time_units = 'days since 1970-01-01'
+
+#Chunks of the cube variables (time, y, x)
+chunk_shape = (32, 128, 128)
+
+def cube_grid(datepath, polygon=None, step=1, store=None):
+    """
+    Pixel window of a scene covered by the cube and its decimated shape
+    """
+
+    shape = utils_plot.scene_shape(datepath, store)
+    window = geo_index.polygon_window(datepath, polygon, store) if polygon is not None else None
+    if window is None:
+        window = (0, shape[0], 0, shape[1])
+
+    r0, r1, c0, c1 = window
+    return window, (len(range(r0, r1, step)), len(range(c0, c1, step)))
+
+def _formulas(indices):
+    """
+    Signatures of the index definitions (see wq_indices), one per index
+    """
+
+    return ','.join(wq_indices.registry[index].signature() if index in wq_indices.registry else ''
+                    for index in indices)
+
+def _create_cube(cube_path, datepath, indices, window, shape, step, polygon, store):
+
+    nc = Dataset(cube_path, 'w', format='NETCDF4')
+    nc.createDimension('time', None)
+    nc.createDimension('y', shape[0])
+    nc.createDimension('x', shape[1])
+
+    nc.createVariable('time', 'f8', ('time',)).units = time_units
+    nc.createVariable('scene', str, ('time',))
+
+    g = geo_index.grid(datepath, store)
+    if g is not None:
+        rows, cols = band_store.window_slices(window, step)
+        nc.createVariable('lat', 'f8', ('y',))[:] = g[0][rows]
+        nc.createVariable('lon', 'f8', ('x',))[:] = g[1][cols]
+
+    chunks = [min(c, n) for c, n in zip(chunk_shape, (chunk_shape[0],) + shape)]
+    for index in indices:
+        nc.createVariable(index, 'f4', ('time', 'y', 'x'), zlib=True, complevel=1,
+                          chunksizes=chunks, fill_value=np.float32(np.nan))
+
+    nc.setncattr('window', list(window))
+    nc.setncattr('step', step)
+    nc.setncattr('indices', ','.join(indices))
+    nc.setncattr('formula_version', utils_plot.formula_version)
+    nc.setncattr('formulas', _formulas(indices))
+    if polygon is not None:
+        nc.setncattr('polygon', np.array(polygon, dtype='f8').ravel())
+
+    return nc
+
+def build_cube(region_path, cube_path, indices=('chl', 'Turb'), satellite='Sentinel2', polygon=None,
+               step=1, max_bytes=None, store=None):
+    """
+    Create or update the (time, y, x) cube of a region
+
+    Parameters
+    ----------
+    region_path: str
+        Region folder (e.g. paths['region_path'] in the notebook)
+    cube_path: str
+        NetCDF file of the cube; scenes already in it are skipped
+    indices: list
+        Indices stacked in the cube, available for the satellite
+    satellite: str
+        'Landsat8' or 'Sentinel2', the scenes must share one grid
+    polygon: list or None
+        (lon, lat) vertices of the area to keep, see geo_index; the pixels
+        outside of it are left as NaN
+    step: int
+        Decimation of the reads, 1 for full resolution
+
+    Returns the list of scenes added.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    indices = list(indices)
+    scenes = utils_plot.region_scenes(region_path, satellite)
+    if not scenes:
+        return []
+
+    first = os.path.join(region_path, scenes[0][1])
+    sensor = utils_plot.scene_sensor(first)
+    for index in indices:
+        if index not in utils_plot.index_bands[sensor]:
+            raise ValueError('{} is not available for {}'.format(index, sensor))
+    window, shape = cube_grid(first, polygon, step, store)
+
+    if os.path.isfile(cube_path):
+        nc = Dataset(cube_path, 'a')
+        if (list(nc.getncattr('window')) != list(window) or nc.getncattr('step') != step or
+                nc.getncattr('indices') != ','.join(indices)):
+            nc.close()
+            raise ValueError('{} was built with other indices, window or step'.format(cube_path))
+        if (getattr(nc, 'formula_version', None) != utils_plot.formula_version or
+                getattr(nc, 'formulas', None) != _formulas(indices)):
+            # built with other index formulas, its slots are stale
+            nc.close()
+            os.remove(cube_path)
+            nc = _create_cube(cube_path, first, indices, window, shape, step, polygon, store)
+    else:
+        nc = _create_cube(cube_path, first, indices, window, shape, step, polygon, store)
+
+    added = []
+    try:
+        slots = list(nc.variables['scene'][:]) if len(nc.dimensions['time']) else []
+        done = set(f for f in slots if f)
+        # slots of an interrupted build, without a scene, are written again
+        free = [t for t, f in enumerate(slots) if not f]
+        r0, r1, c0, c1 = window
+
+        for date, f in scenes:
+            if f in done:
+                continue
+
+            datepath = os.path.join(region_path, f)
+            if utils_plot.scene_shape(datepath, store) != utils_plot.scene_shape(first, store):
+                raise ValueError('{} is not on the grid of {}'.format(f, scenes[0][1]))
+
+            var = store.dataset(datepath).variables[utils_plot.index_bands[sensor]['NDWI'][0]]
+            # blocks aligned on the decimation step
+            block = wq_tiles.block_shape(var, max_bytes)
+            block = (max(step, block[0] - block[0] % step), max(step, block[1] - block[1] % step))
+
+            t = free.pop(0) if free else len(nc.dimensions['time'])
+            try:
+                for br0, br1, bc0, bc1 in wq_tiles.raster_blocks((r1 - r0, c1 - c0), block):
+                    block_window = (r0 + br0, r0 + br1, c0 + bc0, c0 + bc1)
+                    results = wq_tiles.index_block(datepath, indices, block_window, store, step)
+                    y0, x0 = br0 // step, bc0 // step
+                    for index in indices:
+                        arr = geo_index.clip(results[index], datepath, polygon, block_window, step, store)
+                        arr = np.ma.filled(arr.astype('float32'), np.nan)
+                        nc.variables[index][t, y0:y0 + arr.shape[0], x0:x0 + arr.shape[1]] = arr
+
+                # the scene marks the slot as complete, so it goes last
+                nc.variables['time'][t] = date2num(date, time_units)
+                nc.variables['scene'][t] = f
+            except BaseException:
+                if t < len(nc.dimensions['time']):
+                    for index in indices:
+                        nc.variables[index][t] = np.nan
+                    nc.variables['scene'][t] = ''
+                raise
+            nc.sync()
+            added.append(f)
+    finally:
+        nc.close()
+
+    return added
+
+def cube_times(nc):
+    """
+    Acquisition dates of a cube and the order sorting them
+    """
+
+    days = nc.variables['time'][:]
+    order = np.argsort(days, kind='stable')
+
+    return num2date(days[order], time_units), order
+
+def cube_blocks(nc, index, max_bytes=None):
+    """
+    Spatial windows (y0, y1, x0, x1) of a cube holding every date of a
+    block within the memory budget
+    """
+
+    if max_bytes is None:
+        max_bytes = wq_tiles.block_bytes
+
+    var = nc.variables[index]
+    ntime, ny, nx = var.shape
+    chunks = var.chunking()
+    cy, cx = (chunks[1], chunks[2]) if isinstance(chunks, list) else (ny, nx)
+
+    # square groups of whole chunks
+    k = max(1, int(np.sqrt(max_bytes / float(max(ntime, 1) * cy * cx * 4))))
+    return wq_tiles.raster_blocks((ny, nx), (min(ny, k * cy), min(nx, k * cx)))
+
+def _output(nc, name, like, dims):
+
+    if name not in nc.variables:
+        chunks = like.chunking()
+        nc.createVariable(name, 'f4', dims, zlib=True, complevel=1,
+                          chunksizes=chunks if len(dims) == 3 else chunks[1:],
+                          fill_value=np.float32(np.nan))
+
+    return nc.variables[name]
+
+def rolling_mean(cube_path, index, scenes=3, min_count=1, max_bytes=None):
+    """
+    Trailing mean of each pixel over the last `scenes` dates, ignoring the
+    gaps (NaN), written to the cube as <index>_rolling
+
+    Returns the name of the new variable.
+    """
+
+    name = '{}_rolling'.format(index)
+    with Dataset(cube_path, 'a') as nc:
+        var = nc.variables[index]
+        out = _output(nc, name, var, ('time', 'y', 'x'))
+        dates, order = cube_times(nc)
+
+        for y0, y1, x0, x1 in cube_blocks(nc, index, max_bytes):
+            block = np.ma.filled(var[:, y0:y1, x0:x1], np.nan)[order]
+            valid = ~np.isnan(block)
+
+            # windowed sums from cumulative sums along time
+            sums = np.cumsum(np.where(valid, block, 0.), axis=0, dtype='float64')
+            counts = np.cumsum(valid, axis=0)
+            sums[scenes:] = sums[scenes:] - sums[:-scenes]
+            counts[scenes:] = counts[scenes:] - counts[:-scenes]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = (sums / counts).astype('float32')
+            mean[counts < min_count] = np.nan
+
+            result = np.empty_like(mean)
+            result[order] = mean
+            out[:, y0:y1, x0:x1] = result
+
+    return name
+
+def linear_trend(cube_path, index, min_count=3, max_bytes=None):
+    """
+    Least squares linear trend of each pixel over time, ignoring the gaps
+
+    Returns a dict of 2D arrays: 'slope' (units per year), 'intercept'
+    (value at the first date), 'count' (dates used); pixels with fewer than
+    min_count dates are NaN. The slope is also written to the cube as
+    <index>_trend.
+    """
+
+    with Dataset(cube_path, 'a') as nc:
+        var = nc.variables[index]
+        out = _output(nc, '{}_trend'.format(index), var, ('y', 'x'))
+        dates, order = cube_times(nc)
+
+        days = nc.variables['time'][:].astype('float64')
+        years = (days - days.min()) / 365.25 if days.size else days
+
+        ny, nx = var.shape[1:]
+        trend = {'slope': np.full((ny, nx), np.nan, dtype='float32'),
+                 'intercept': np.full((ny, nx), np.nan, dtype='float32'),
+                 'count': np.zeros((ny, nx), dtype='int32')}
+
+        for y0, y1, x0, x1 in cube_blocks(nc, index, max_bytes):
+            block = np.ma.filled(var[:, y0:y1, x0:x1], np.nan).astype('float64')
+            valid = ~np.isnan(block)
+            t = np.where(valid, years[:, None, None], 0.)
+            v = np.where(valid, block, 0.)
+
+            n = valid.sum(axis=0)
+            st, sv = t.sum(axis=0), v.sum(axis=0)
+            stt, stv = (t * t).sum(axis=0), (t * v).sum(axis=0)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                slope = (n * stv - st * sv) / (n * stt - st * st)
+                intercept = (sv - slope * st) / n
+            few = (n < min_count) | ~np.isfinite(slope)
+            slope[few], intercept[few] = np.nan, np.nan
+
+            trend['slope'][y0:y1, x0:x1] = slope
+            trend['intercept'][y0:y1, x0:x1] = intercept
+            trend['count'][y0:y1, x0:x1] = n
+            out[y0:y1, x0:x1] = slope.astype('float32')
+
+    return trend
+
+def zscore_anomaly(cube_path, index, min_count=3, max_bytes=None):
+    """
+    Standardized anomaly (value - pixel mean) / pixel std of every date,
+    written to the cube as <index>_anomaly
+
+    Returns the name of the new variable.
+    """
+
+    name = '{}_anomaly'.format(index)
+    with Dataset(cube_path, 'a') as nc:
+        var = nc.variables[index]
+        out = _output(nc, name, var, ('time', 'y', 'x'))
+
+        for y0, y1, x0, x1 in cube_blocks(nc, index, max_bytes):
+            block = np.ma.filled(var[:, y0:y1, x0:x1], np.nan).astype('float64')
+            valid = ~np.isnan(block)
+
+            n = valid.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(valid, block, 0.).sum(axis=0) / n
+                var_t = np.where(valid, (block - mean) ** 2, 0.).sum(axis=0) / n
+                z = (block - mean) / np.sqrt(var_t)
+
+            z[:, n < min_count] = np.nan
+            z[~np.isfinite(z)] = np.nan
+            out[:, y0:y1, x0:x1] = z.astype('float32')
+
+    return name
+
+def pixel_series(cube_path, index, lat, lon):
+    """
+    (dates, values) of the pixel of the cube nearest to a point, by date
+    """
+
+    with Dataset(cube_path, 'r') as nc:
+        y = int(np.abs(nc.variables['lat'][:] - lat).argmin())
+        x = int(np.abs(nc.variables['lon'][:] - lon).argmin())
+        dates, order = cube_times(nc)
+        values = np.ma.filled(nc.variables[index][:, y, x], np.nan)[order]
+
+    return list(dates), values
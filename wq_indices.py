@@ -0,0 +1,360 @@
+"""
+Registry of the water quality indices
+
+Each index is declared once: its formula over band roles (e.g. 'nir',
+'red'), the band variable of each role for every sensor, and its mask
+rules. Formulas are compiled into kernels, sequences of NumPy ufuncs
+writing into block-sized buffers, and compute() evaluates several indices
+in one pass over blocks of rows of the bands: each band block is read once
+for all of them and no full size temporaries are created.
+
+New indices are added with register(); they show up in the notebook and
+in every tool working from utils_plot.index_bands.
+"""
+import ast
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+#Rows evaluated at a time
+chunk_rows = 512
+
+#Green and NIR bands of the NDWI water mask of each sensor
+water_bands = {'landsat': ('SRB3', 'SRB5'),
+               'sentinel': ('B3', 'B8')}
+
+#Band variables of each sensor, with the labels shown in the notebook
+band_labels = {'landsat': OrderedDict([('B1 [435nm-451nm]', 'SRB1'),
+                                       ('B2 Blue [452nm-512nm]', 'SRB2'),
+                                       ('B3 Green [533nm-590nm]', 'SRB3'),
+                                       ('B4 Red [636nm-673nm]', 'SRB4'),
+                                       ('B5 [851nm-879nm]', 'SRB5'),
+                                       ('B6 [1566nm-1651nm]', 'SRB6'),
+                                       ('B7 [2107nm-2294nm]', 'SRB7'),
+                                       ('B8 [503nm-676nm]', 'B8'),
+                                       ('B9 [1363nm-1384nm]', 'SRB9'),
+                                       ('B10 [1060nm-1119nm]', 'SRB10'),
+                                       ('B11 [1150nm-1251nm]', 'SRB11')]),
+               'sentinel': OrderedDict([('B1 [443 nm]', 'SRB1'),
+                                        ('B2 Blue [490 nm]', 'B2'),
+                                        ('B3 Green [560 nm]', 'B3'),
+                                        ('B4 Red [665 nm]', 'B4'),
+                                        ('B5 [705 nm]', 'SRB5'),
+                                        ('B6 [740 nm]', 'SRB6'),
+                                        ('B7 [783 nm]', 'SRB7'),
+                                        ('B8 [842 nm]', 'B8'),
+                                        ('B8A [865 nm]', 'SRB8A'),
+                                        ('B9 [945 nm]', 'SRB9'),
+                                        ('B10 [1375 nm]', 'SRB10'),
+                                        ('B11 [1610 nm]', 'SRB11'),
+                                        ('B12 [2190 nm]', 'SRB12')])}
+
+_binary = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.divide, ast.Pow: np.power}
+
+_functions = {'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'exp': np.exp}
+
+class Kernel(object):
+    """
+    Formula compiled to a list of ufunc calls on block buffers
+
+    Parameters
+    ----------
+    formula: str
+        Arithmetic expression (+ - * / **, abs, sqrt, log, exp) of band
+        roles and constants, e.g. '(nir - red) / (blue + green)'
+    constants: dict
+        Values of the names of the formula that are not bands
+    """
+
+    def __init__(self, formula, constants=None):
+
+        self.formula = formula
+        self.constants = dict(constants or {})
+        self.inputs = []
+        self.program = []
+        self.registers = 0
+        self._free = []
+
+        result = self._compile(ast.parse(formula, mode='eval').body)
+        if result[0] == 'reg':
+            # the last instruction writes straight into the output
+            ufunc, dst, args = self.program[-1]
+            self.program[-1] = (ufunc, ('out', None), args)
+        self.result = result
+
+    def _register(self, *operands):
+
+        for op in operands:
+            if op[0] == 'reg':
+                self._free.append(op[1])
+        if self._free:
+            return ('reg', self._free.pop(0))
+
+        self.registers += 1
+        return ('reg', self.registers - 1)
+
+    def _compile(self, node):
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return ('const', float(node.value))
+
+        if isinstance(node, ast.Name):
+            if node.id in self.constants:
+                return ('const', float(self.constants[node.id]))
+            if node.id not in self.inputs:
+                self.inputs.append(node.id)
+            return ('in', node.id)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary:
+            a, b = self._compile(node.left), self._compile(node.right)
+            if a[0] == 'const' and b[0] == 'const':
+                return ('const', float(_binary[type(node.op)](a[1], b[1])))
+            dst = self._register(a, b)
+            self.program.append((_binary[type(node.op)], dst, (a, b)))
+            return dst
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            a = self._compile(node.operand)
+            if a[0] == 'const':
+                return ('const', -a[1])
+            dst = self._register(a)
+            self.program.append((np.negative, dst, (a,)))
+            return dst
+
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+                node.func.id in _functions and len(node.args) == 1):
+            a = self._compile(node.args[0])
+            dst = self._register(a)
+            self.program.append((_functions[node.func.id], dst, (a,)))
+            return dst
+
+        raise ValueError('Unsupported expression in {!r}: {}'.format(self.formula, ast.dump(node)))
+
+    def __call__(self, inputs, out, buffers):
+        """
+        Evaluate on one block: inputs maps roles to float32 blocks, out is
+        the output block and buffers the block-sized scratch arrays
+        """
+
+        def value(op):
+            kind, v = op
+            if kind == 'in':
+                return inputs[v]
+            if kind == 'reg':
+                return buffers[v][:out.shape[0]]
+            if kind == 'out':
+                return out
+            return v
+
+        if not self.program:
+            np.copyto(out, value(self.result), casting='unsafe')
+            return out
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for ufunc, dst, args in self.program:
+                ufunc(*[value(a) for a in args], out=value(dst))
+
+        return out
+
+class Index(object):
+    """
+    Water quality index of the registry
+
+    Parameters
+    ----------
+    name: str
+        Name shown in the notebook and used for the outputs
+    formula: str
+        Expression of band roles, see Kernel
+    bands: dict
+        {sensor: {role: band variable}} for the sensors providing it
+    constants: dict or None
+        {sensor: {name: value}} of the non-band names of the formula
+    water_mask: bool
+        Mask the pixels outside the NDWI water mask
+    description: str
+        One line shown to the users
+    """
+
+    def __init__(self, name, formula, bands, constants=None, water_mask=True, description=''):
+
+        self.name, self.formula, self.bands = name, formula, bands
+        self.constants = constants or {}
+        self.water_mask = water_mask
+        self.description = description
+        self._kernels = {}
+
+        for sensor in bands:
+            missing = set(self.kernel(sensor).inputs) - set(bands[sensor])
+            if missing:
+                raise ValueError('{}: no {} band for {}'.format(name, ', '.join(sorted(missing)), sensor))
+
+    def kernel(self, sensor):
+
+        if sensor not in self._kernels:
+            self._kernels[sensor] = Kernel(self.formula, self.constants.get(sensor))
+
+        return self._kernels[sensor]
+
+    def variables(self, sensor):
+        """
+        Band variables read by the formula
+        """
+
+        return [self.bands[sensor][role] for role in self.kernel(sensor).inputs]
+
+    def signature(self):
+        """
+        Hash of the definition, products computed with another one are stale
+        """
+
+        definition = repr((self.formula, sorted((s, sorted(b.items())) for s, b in self.bands.items()),
+                           sorted((s, sorted(c.items())) for s, c in self.constants.items()),
+                           self.water_mask))
+
+        return hashlib.md5(definition.encode()).hexdigest()[:12]
+
+#Indices by name, in the order shown in the notebook
+registry = OrderedDict()
+
+#{sensor: {index: band variables}}, NDWI bands first (see utils_plot)
+index_bands = {}
+
+def register(name, formula, bands, constants=None, water_mask=True, description=''):
+    """
+    Add (or replace) an index of the registry
+    """
+
+    index = Index(name, formula, bands, constants, water_mask, description)
+    registry[name] = index
+
+    # a replaced index may not cover the sensors it used to
+    for sensor in index_bands:
+        if sensor not in index.bands:
+            index_bands[sensor].pop(name, None)
+
+    for sensor in index.bands:
+        variables = list(water_bands[sensor])
+        variables += [v for v in index.variables(sensor) if v not in variables]
+        index_bands.setdefault(sensor, OrderedDict())[name] = variables
+
+    return index
+
+def available(sensor):
+    """
+    Names of the indices a sensor provides
+    """
+
+    return [name for name, index in registry.items() if sensor in index.bands]
+
+def compute(band_dict, sensor, names, mask=None, rows=None):
+    """
+    Several indices of a scene (or block) in one pass over its bands
+
+    Parameters
+    ----------
+    band_dict: dict
+        Band arrays by variable name, see utils_plot.index_bands
+    sensor: str
+        'landsat' or 'sentinel'
+    names: list
+        Indices to compute
+    mask: bool array or None
+        Non-water mask (True outside the water), computed if None
+
+    Returns a dict of masked float32 arrays, masked outside the water,
+    where the index is NaN and where any of its bands is masked.
+    """
+
+    if rows is None:
+        rows = chunk_rows
+
+    for name in names:
+        if name not in registry or sensor not in registry[name].bands:
+            raise ValueError('{} is not available for {}'.format(name, sensor))
+
+    indices = [registry[name] for name in names]
+    green, nir = water_bands[sensor]
+    shape = np.shape(band_dict[green])
+    water = registry['NDWI'] if mask is None else None
+
+    used = set(v for index in indices for v in index.variables(sensor))
+    if water is not None:
+        used.update((green, nir))
+
+    kernels = [(index, index.kernel(sensor)) for index in indices]
+    nregs = max([k.registers for i, k in kernels] + [water.kernel(sensor).registers if water else 0])
+    block = min(rows, shape[0])
+    buffers = [np.empty((block,) + shape[1:], dtype='float32') for _ in range(nregs)]
+
+    data = dict((v, np.ma.getdata(band_dict[v])) for v in used)
+    band_masks = dict((v, np.ma.getmask(band_dict[v])) for v in used)
+
+    results = dict((index.name, np.empty(shape, dtype='float32')) for index in indices)
+    masks = dict((index.name, np.empty(shape, dtype=bool)) for index in indices)
+    if mask is None:
+        mask = np.empty(shape, dtype=bool)
+        ndwi = np.empty((block,) + shape[1:], dtype='float32')
+
+    for r0 in range(0, shape[0], rows):
+        r1 = min(r0 + rows, shape[0])
+
+        # each band block converted once, for every index
+        blocks = dict((v, np.asarray(data[v][r0:r1], dtype='float32')) for v in used)
+
+        if water is not None:
+            w = water.kernel(sensor)
+            w(dict((role, blocks[water.bands[sensor][role]]) for role in w.inputs),
+              ndwi[:r1 - r0], buffers)
+            np.less_equal(ndwi[:r1 - r0], 0, out=mask[r0:r1])
+            mask[r0:r1] |= np.isnan(ndwi[:r1 - r0])
+            for v in (green, nir):
+                if band_masks[v] is not np.ma.nomask:
+                    mask[r0:r1] |= band_masks[v][r0:r1]
+
+        for index, kernel in kernels:
+            roles = dict((role, blocks[index.bands[sensor][role]]) for role in kernel.inputs)
+            out = kernel(roles, results[index.name][r0:r1], buffers)
+
+            m = masks[index.name][r0:r1]
+            np.isnan(out, out=m)
+            if index.water_mask:
+                m |= mask[r0:r1]
+            for v in index.variables(sensor):
+                if band_masks[v] is not np.ma.nomask:
+                    m |= band_masks[v][r0:r1]
+
+    return dict((name, np.ma.masked_array(results[name], mask=masks[name], copy=False)) for name in names)
+
+register('chl', '(nir - red) / (blue + green)',
+         {'landsat': {'nir': 'SRB5', 'red': 'SRB4', 'blue': 'SRB2', 'green': 'SRB3'},
+          'sentinel': {'nir': 'SRB8A', 'red': 'B4', 'blue': 'B2', 'green': 'B3'}},
+         description='Chlorophyll ratio (NIR - Red) / (Blue + Green)')
+
+register('Turb', '(red - green) / (red + green)',
+         {'landsat': {'red': 'SRB4', 'green': 'SRB3'},
+          'sentinel': {'red': 'B4', 'green': 'B3'}},
+         description='Normalized Difference Turbidity Index (Red - Green) / (Red + Green)')
+
+register('Temp', 'thermal',
+         {'landsat': {'thermal': 'SRB10'}},
+         description='Surface temperature (thermal band)')
+
+register('NDWI', '(green - nir) / (green + nir)',
+         {'landsat': {'green': 'SRB3', 'nir': 'SRB5'},
+          'sentinel': {'green': 'B3', 'nir': 'B8'}},
+         description='Normalized Difference Water Index (Green - NIR) / (Green + NIR)')
+
+register('NDCI', '(rededge - red) / (rededge + red)',
+         {'sentinel': {'rededge': 'SRB5', 'red': 'B4'}},
+         description='Normalized Difference Chlorophyll Index (705 nm - 665 nm) / (705 nm + 665 nm)')
+
+# NIR minus the Red-SWIR baseline interpolated at the NIR wavelength
+register('FAI', 'nir - (red + (swir - red) * k)',
+         {'landsat': {'red': 'SRB4', 'nir': 'SRB5', 'swir': 'SRB6'},
+          'sentinel': {'red': 'B4', 'nir': 'SRB8A', 'swir': 'SRB11'}},
+         constants={'landsat': {'k': (865. - 655.) / (1609. - 655.)},
+                    'sentinel': {'k': (865. - 665.) / (1610. - 665.)}},
+         description='Floating Algae Index')
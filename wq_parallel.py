@@ -0,0 +1,97 @@
+"""
+Parallel computation of the water quality indices
+
+Tiles of a scene are computed on a thread pool (NumPy releases the GIL in
+the band math) and whole scenes of a region on a process pool. Results are
+always reassembled in tile/date order, whatever the completion order.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+import band_store
+import utils_plot
+import wq_tiles
+
+def default_workers():
+    """
+    Number of workers: the cores available to this process
+    """
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def process_pool(workers):
+    """
+    Process pool of the scene jobs, with spawned workers: forked ones would
+    inherit the open NetCDF/HDF5 handles of band_store.store
+    """
+
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def parallel_index(datepath, indices, workers=None, max_bytes=None, store=None):
+    """
+    Compute indices of a whole scene with its tiles spread over threads
+
+    Returns a dict of masked arrays, one per index.
+    """
+
+    if store is None:
+        store = band_store.store
+    if workers is None:
+        workers = default_workers()
+
+    sensor = utils_plot.scene_sensor(datepath)
+    var = store.dataset(datepath).variables[utils_plot.index_bands[sensor]['NDWI'][0]]
+    shape = var.shape
+    windows = list(wq_tiles.raster_blocks(shape, wq_tiles.block_shape(var, max_bytes)))
+
+    results = {}
+    for index in indices:
+        results[index] = np.ma.masked_all(shape, dtype='float32')
+
+    def compute(window):
+        return window, wq_tiles.index_block(datepath, indices, window, store)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for window, block in wq_tiles.imap_ordered(executor, compute, windows, 2 * workers):
+            r0, r1, c0, c1 = window
+            for index in indices:
+                results[index][r0:r1, c0:c1] = block[index]
+
+    return results
+
+def _scene_job(args):
+
+    datepath, indices, out_path, max_bytes = args
+    return wq_tiles.tiled_wq(datepath, indices, out_path, max_bytes)
+
+def region_wq(region_path, indices, out_dir, workers=None, max_bytes=None):
+    """
+    Compute indices for every scene of a region folder on a process pool
+    (one scene per process, see wq_tiles.tiled_wq for the tiles of a scene)
+
+    Each scene is written to `out_dir` as <scene>_wq.nc. Returns a list of
+    (date, output path) sorted by date.
+    """
+
+    if workers is None:
+        workers = default_workers()
+
+    scenes = utils_plot.region_scenes(region_path)
+    jobs = []
+    for date, f in scenes:
+        out_path = os.path.join(out_dir, '{}_wq.nc'.format(os.path.splitext(f)[0]))
+        # e.g. no Temp for Sentinel-2
+        available = utils_plot.index_bands[utils_plot.scene_sensor(f)]
+        scene_indices = [i for i in indices if i in available]
+        jobs.append((os.path.join(region_path, f), scene_indices, out_path, max_bytes))
+
+    with process_pool(workers) as executor:
+        out_paths = list(executor.map(_scene_job, jobs))
+
+    return [(date, out_path) for (date, f), out_path in zip(scenes, out_paths)]
@@ -0,0 +1,215 @@
+"""
+Single pass statistics of bands and indices
+
+min/max/mean/std are accumulated block by block with the parallel variance
+update (Welford/Chan) and percentiles are taken from a fixed-size uniform
+sample of the pixels (exact while every pixel fits in it), so a raster
+streamed in blocks is read once for all its statistics. Arrays already in
+memory get exact percentiles.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import utils_plot
+import wq_indices
+
+#Rows per block when an in-memory array is walked
+chunk_rows = 512
+
+class RunningStats(object):
+    """
+    Streaming count, min, max, mean, std and approximate percentiles
+
+    Parameters
+    ----------
+    sample: int
+        Pixels kept for the percentiles, drawn uniformly (reservoir)
+    seed: int
+        Seed of the sampling, for repeatable percentiles
+    """
+
+    def __init__(self, sample=65536, seed=0):
+
+        self.sample = sample
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.values = np.empty(0, dtype='float64')
+        self._random = np.random.default_rng(seed)
+
+    def update(self, arr):
+        """
+        Add the valid (unmasked, finite) pixels of a block
+        """
+        values = np.ma.compressed(arr)
+        values = values[np.isfinite(values)].astype('float64')
+        if values.size == 0:
+            return self
+
+        # moments of the block, merged with the running ones
+        n_b = values.size
+        mean_b = values.mean()
+        m2_b = np.square(values - mean_b).sum()
+        vmin, vmax = values.min(), values.max()
+
+        self._resample(values, n_b)
+
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta**2 * self.count * n_b / n
+        self.count = n
+        self.min, self.max = min(self.min, vmin), max(self.max, vmax)
+
+        return self
+
+    def merge(self, other):
+        """
+        Add the pixels summarized by another RunningStats
+        """
+        if other.count == 0:
+            return self
+
+        self._resample(other.values, other.count)
+
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / n
+        self.m2 += other.m2 + delta**2 * self.count * other.count / n
+        self.count = n
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+        return self
+
+    def _resample(self, values, count):
+        """
+        Merge the sample with a uniform sample (values) of count new pixels,
+        before self.count is updated
+        """
+        if not self.sample:
+            return
+
+        total = self.count + count
+        if total <= self.sample:
+            self.values = np.concatenate([self.values, values])
+            return
+
+        # pixels of the merged sample coming from the new ones
+        k = self.sample
+        m = int(self._random.hypergeometric(count, self.count, k)) if self.count else k
+        new = self._random.choice(values, m, replace=False) if m < values.size else values
+        old = self._random.choice(self.values, k - m, replace=False) if k - m < self.values.size else self.values
+        self.values = np.concatenate([old, new])
+
+    @property
+    def std(self):
+
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def percentile(self, q):
+        """
+        q-th percentile (0-100) of the sample, exact while count <= sample
+        """
+        if self.count == 0:
+            return np.nan
+
+        return float(np.percentile(self.values, q))
+
+    def result(self, percentiles=()):
+        """
+        dict with count, min, max, mean, std and the requested percentiles
+        """
+        empty = self.count == 0
+        stats = {'count': self.count,
+                 'min': np.nan if empty else self.min,
+                 'max': np.nan if empty else self.max,
+                 'mean': np.nan if empty else self.mean,
+                 'std': self.std}
+        for q in percentiles:
+            stats[q] = self.percentile(q)
+
+        return stats
+
+def array_stats(arr, percentiles=(2.5, 97.5), rows=None):
+    """
+    Statistics of a (masked) array in one pass over blocks of rows
+    """
+
+    if rows is None:
+        rows = chunk_rows
+
+    stats = RunningStats(sample=0)
+    for r0 in range(0, arr.shape[0], rows):
+        stats.update(arr[r0:r0 + rows])
+    result = stats.result()
+
+    # exact percentiles, the array is in memory
+    if percentiles and stats.count:
+        values = np.ma.compressed(arr)
+        values = values[np.isfinite(values)]
+        for q, v in zip(percentiles, np.percentile(values, percentiles)):
+            result[q] = float(v)
+    else:
+        for q in percentiles:
+            result[q] = np.nan
+
+    return result
+
+#Statistics kept in memory
+max_stats = 256
+
+#Statistics already computed, by scene, band/index, window, step, source
+#mtime and formula version (LRU)
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def _version(datepath, name):
+    """
+    Source mtime and formula version of a band or index, stats computed
+    with other ones are stale
+    """
+
+    try:
+        mtime = os.path.getmtime(datepath)
+    except OSError:
+        mtime = None
+
+    base = name[0] if isinstance(name, tuple) else name
+    index = wq_indices.registry.get(base)
+
+    return mtime, utils_plot.formula_version, index.signature() if index is not None else ''
+
+def cached_stats(datepath, name, arr, window=None, step=1, percentiles=(2.5, 97.5)):
+    """
+    Statistics of a band or index of a scene, computed once
+    """
+
+    key = (datepath, name, window, step, tuple(percentiles)) + _version(datepath, name)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    st = array_stats(arr, percentiles)
+
+    with _lock:
+        _cache[key] = st
+        while len(_cache) > max_stats:
+            _cache.popitem(last=False)
+
+    return st
+
+def clear(datepath=None):
+    """
+    Forget the statistics of a scene (or of every scene)
+    """
+
+    with _lock:
+        for key in list(_cache):
+            if datepath is None or key[0] == datepath:
+                del _cache[key]
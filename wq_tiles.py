@@ -0,0 +1,216 @@
+"""
+Tiled computation of the water quality indices
+
+Scenes are processed block by block, with blocks aligned to the NetCDF
+chunking, and the results are written to a NetCDF or GeoTIFF file. Only
+the bands of one block are in memory at a time, so mosaics larger than
+the worker memory can be processed.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from netCDF4 import Dataset
+
+import band_store
+import utils_plot
+import wq_indices
+
+#Memory budget (bytes) of one band block
+block_bytes = 64 * 1024**2
+
+def block_shape(var, max_bytes=None):
+    """
+    Block shape for a 2D variable: whole chunks, within the memory budget
+    """
+
+    if max_bytes is None:
+        max_bytes = block_bytes
+
+    nrows, ncols = var.shape
+    chunking = var.chunking()
+    if not isinstance(chunking, list):
+        chunking = [1, ncols]
+    chunk_r, chunk_c = chunking
+
+    # full rows of chunks if they fit, otherwise square groups of chunks
+    itemsize = max(var.dtype.itemsize, 4)
+    rows = max_bytes // (ncols * itemsize)
+    if rows >= chunk_r:
+        return (min(nrows, rows - rows % chunk_r), ncols)
+
+    k = max(1, int(np.sqrt(max_bytes / float(chunk_r * chunk_c * itemsize))))
+    return (min(nrows, k * chunk_r), min(ncols, k * chunk_c))
+
+def raster_blocks(shape, block):
+    """
+    Yield the pixel windows (row_start, row_stop, col_start, col_stop)
+    covering a raster
+    """
+
+    nrows, ncols = shape
+    for r0 in range(0, nrows, block[0]):
+        for c0 in range(0, ncols, block[1]):
+            yield (r0, min(r0 + block[0], nrows), c0, min(c0 + block[1], ncols))
+
+def index_block(datepath, indices, window, store=None, step=1):
+    """
+    Compute several indices on one block of a scene
+
+    The block bands are read straight from the file (decimated by step) and
+    are not kept in the band store.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    sensor = utils_plot.scene_sensor(datepath)
+    bands = set(utils_plot.index_bands[sensor]['NDWI'])
+    for index in indices:
+        bands.update(utils_plot.index_bands[sensor][index])
+
+    band_dict = {b: store.read(datepath, b, window, step) for b in bands}
+
+    # water mask and indices in one pass over the block
+    return wq_indices.compute(band_dict, sensor, indices)
+
+def imap_ordered(executor, func, items, ahead):
+    """
+    Map func over items on an executor, yielding the results in order
+
+    At most `ahead` tasks are in flight, so finished results do not pile up
+    while an earlier one is still running.
+    """
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+def create_netcdf(out_path, dataset, shape, block, indices):
+    """
+    Output NetCDF with the grid and coordinates of a scene and one float
+    variable per index
+    """
+
+    nc = Dataset(out_path, 'w', format='NETCDF4_CLASSIC')
+
+    band = next(v for v in dataset.variables.values() if v.ndim == 2)
+    for dim, size in zip(band.dimensions, shape):
+        nc.createDimension(dim, size)
+
+    # keep the coordinates of the scene
+    for name in band.dimensions:
+        if name in dataset.variables and dataset.variables[name].ndim == 1:
+            coord = nc.createVariable(name, dataset.variables[name].dtype, (name,))
+            coord[:] = dataset.variables[name][:]
+
+    # same chunking as the scene, so the output reads back block aligned
+    chunks = band.chunking()
+    if not isinstance(chunks, list):
+        chunks = [min(block[0], shape[0]), min(block[1], shape[1])]
+    for index in indices:
+        nc.createVariable(index, 'f4', band.dimensions, zlib=True,
+                          chunksizes=chunks, fill_value=np.float32(np.nan))
+
+    return nc
+
+def create_geotiff(out_path, dataset, shape, indices):
+    """
+    Tiled GeoTIFF with one band per index, georeferenced from the scene
+    """
+
+    from osgeo import gdal, osr
+
+    driver = gdal.GetDriverByName('GTiff')
+    tif = driver.Create(out_path, shape[1], shape[0], len(indices), gdal.GDT_Float32,
+                        options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+
+    lat = utils_plot.coordinate_axis(dataset, ('lat', 'latitude'), 0)
+    lon = utils_plot.coordinate_axis(dataset, ('lon', 'longitude'), 1)
+    if lat is not None and lon is not None and lat.size > 1 and lon.size > 1:
+        dx = (lon[-1] - lon[0]) / (lon.size - 1)
+        dy = (lat[-1] - lat[0]) / (lat.size - 1)
+        tif.SetGeoTransform((lon[0] - dx / 2., dx, 0, lat[0] - dy / 2., 0, dy))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        tif.SetProjection(srs.ExportToWkt())
+
+    for n, index in enumerate(indices):
+        band = tif.GetRasterBand(n + 1)
+        band.SetDescription(index)
+        band.SetNoDataValue(np.nan)
+
+    return tif
+
+def tiled_wq(datepath, indices, out_path, max_bytes=None, store=None, workers=1):
+    """
+    Compute water quality indices block by block and write them to a file
+
+    Parameters
+    ----------
+    datepath: str
+        Scene file
+    indices: list
+        Indices to compute (e.g. ['chl', 'Turb', 'Temp'])
+    out_path: str
+        Output file, GeoTIFF if it ends with .tif/.tiff, NetCDF otherwise
+    max_bytes: int
+        Memory budget of one band block
+    workers: int
+        Threads computing blocks. Blocks are still written in order and at
+        most two blocks per worker are held in memory.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    sensor = utils_plot.scene_sensor(datepath)
+    dataset = store.dataset(datepath)
+    var = dataset.variables[utils_plot.index_bands[sensor]['NDWI'][0]]
+    shape = var.shape
+    block = block_shape(var, max_bytes)
+
+    geotiff = os.path.splitext(out_path)[1].lower() in ('.tif', '.tiff')
+    if geotiff:
+        out = create_geotiff(out_path, dataset, shape, indices)
+    else:
+        out = create_netcdf(out_path, dataset, shape, block, indices)
+
+    def compute(window):
+        return window, index_block(datepath, indices, window, store)
+
+    try:
+        windows = raster_blocks(shape, block)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for window, results in imap_ordered(executor, compute, windows, 2 * workers):
+                    write_block(out, indices, window, results, geotiff)
+        else:
+            for window, results in map(compute, windows):
+                write_block(out, indices, window, results, geotiff)
+    finally:
+        if geotiff:
+            out.FlushCache()
+        else:
+            out.close()
+
+    return out_path
+
+def write_block(out, indices, window, results, geotiff=False):
+    """
+    Write the indices of one block to an open NetCDF or GDAL dataset
+    """
+
+    r0, r1, c0, c1 = window
+    for n, index in enumerate(indices):
+        arr = np.ma.filled(results[index].astype('float32'), np.nan)
+        if geotiff:
+            out.GetRasterBand(n + 1).WriteArray(arr, c0, r0)
+        else:
+            out.variables[index][r0:r1, c0:c1] = arr
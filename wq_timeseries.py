@@ -0,0 +1,137 @@
+"""
+Time series of water quality summaries over the scenes of a region
+
+Walks a region folder, computes for every scene the statistics of the
+indices over the water mask in one streamed pass (block by block, see
+wq_stats) and returns them as a NumPy structured array, one row per date.
+"""
+import os
+import csv
+
+import numpy as np
+
+import band_store
+import utils_plot
+import wq_tiles
+import wq_parallel
+import wq_stats
+import geo_index
+
+#Statistics computed for each index
+stat_names = ['count', 'mean', 'std', 'min', 'max']
+
+def scene_summary(datepath, indices, max_bytes=None, step=1, store=None, polygon=None):
+    """
+    Statistics of the indices of a scene over its water pixels
+
+    Only the blocks of the bounding box of polygon (lon, lat vertices, see
+    geo_index) are read, and the pixels outside of it are left out.
+
+    Returns a dict {index: {'count', 'mean', 'std', 'min', 'max'}}, indices
+    the sensor does not provide are left out.
+    """
+
+    if store is None:
+        store = band_store.store
+
+    sensor = utils_plot.scene_sensor(datepath)
+    indices = [i for i in indices if i in utils_plot.index_bands[sensor]]
+
+    var = store.dataset(datepath).variables[utils_plot.index_bands[sensor]['NDWI'][0]]
+    block = wq_tiles.block_shape(var, max_bytes)
+
+    r0, r1, c0, c1 = (0, var.shape[0], 0, var.shape[1])
+    if polygon is not None:
+        r0, r1, c0, c1 = geo_index.polygon_window(datepath, polygon, store) or (0, 0, 0, 0)
+
+    stats = dict((i, wq_stats.RunningStats()) for i in indices)
+    for br0, br1, bc0, bc1 in wq_tiles.raster_blocks((r1 - r0, c1 - c0), block):
+        window = (r0 + br0, r0 + br1, c0 + bc0, c0 + bc1)
+        results = wq_tiles.index_block(datepath, indices, window, store, step)
+        for i in indices:
+            stats[i].update(geo_index.clip(results[i], datepath, polygon, window, step, store))
+
+    summary = {}
+    for i in indices:
+        summary[i] = stats[i].result()
+
+    return summary
+
+def _summary_job(args):
+
+    datepath, indices, max_bytes, step, polygon = args
+    return scene_summary(datepath, indices, max_bytes, step, polygon=polygon)
+
+def table_dtype(indices):
+    """
+    dtype of the time series table
+    """
+
+    fields = [('date', 'datetime64[D]'), ('satellite', 'U9'), ('scene', 'U80')]
+    for i in indices:
+        for s in stat_names:
+            fields.append(('{}_{}'.format(i, s), 'i8' if s == 'count' else 'f8'))
+
+    return np.dtype(fields)
+
+def region_timeseries(region_path, indices=('chl', 'Turb', 'Temp'), satellite=None,
+                      start=None, end=None, step=1, workers=1, max_bytes=None, polygon=None):
+    """
+    Per-date statistics of water quality indices over a region folder
+
+    Parameters
+    ----------
+    region_path: str
+        Region folder (e.g. paths['region_path'] in the notebook)
+    indices: list
+        Indices to summarize
+    satellite: str or None
+        'Landsat8' or 'Sentinel2' to keep only one of them
+    start, end: datetime or None
+        Date range of the scenes
+    step: int
+        Decimation of the reads, 1 for full resolution
+    workers: int
+        Scenes summarized in parallel (processes)
+    polygon: list or None
+        (lon, lat) vertices of the area to summarize, e.g.
+        geo_index.box_polygon(coordinates), the whole scenes if None
+
+    Returns
+    -------
+    NumPy structured array sorted by date, see table_dtype
+    """
+
+    indices = list(indices)
+    scenes = utils_plot.region_scenes(region_path, satellite, start, end)
+
+    jobs = [(os.path.join(region_path, f), indices, max_bytes, step, polygon) for date, f in scenes]
+    if workers > 1:
+        with wq_parallel.process_pool(workers) as executor:
+            summaries = list(executor.map(_summary_job, jobs))
+    else:
+        summaries = [_summary_job(job) for job in jobs]
+
+    table = np.zeros(len(scenes), dtype=table_dtype(indices))
+    for row, (date, f), summary in zip(table, scenes, summaries):
+        row['date'] = np.datetime64(date.date())
+        row['satellite'] = 'Landsat8' if utils_plot.scene_sensor(f) == 'landsat' else 'Sentinel2'
+        row['scene'] = f
+        for i in indices:
+            for s in stat_names:
+                row['{}_{}'.format(i, s)] = summary[i][s] if i in summary else (0 if s == 'count' else np.nan)
+
+    return table
+
+def save_csv(table, csv_path):
+    """
+    Write a time series table to a CSV file
+    """
+
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        for row in table:
+            writer.writerow([row[name] for name in table.dtype.names])
+
+    return csv_path
@@ -6,25 +6,30 @@ Date: August 2018
 """
 #APIs
 import os
-import requests
-import argparse
 import json
-from netCDF4 import Dataset
-from osgeo import gdal, osr
-import datetime
-import matplotlib.pyplot as plt
+import threading
 import numpy as np
 
-#Subfunctions
-import utils_plot
-
-#Map
-from ipyleaflet import Map, basemaps, basemap_to_tiles, DrawControl
+#Subfunctions, loaded on first use (see lazy.py)
+from lazy import lazy_import
+utils_plot = lazy_import('utils_plot')
+band_store = lazy_import('band_store')
+product_cache = lazy_import('product_cache')
+scene_catalogue = lazy_import('scene_catalogue')
+wq_stats = lazy_import('wq_stats')
+async_tasks = lazy_import('async_tasks')
+orchestrator = lazy_import('orchestrator')
+job_monitor = lazy_import('job_monitor')
+instrumentation = lazy_import('instrumentation')
+local_scenes = lazy_import('local_scenes')
+map_tiles = lazy_import('map_tiles')
+geo_index = lazy_import('geo_index')
+wq_indices = lazy_import('wq_indices')
 
 #widget
 import ipywidgets as widgets
 from ipywidgets import HBox, VBox, Layout
-from ipywidgets import AppLayout, Button, GridspecLayout
+from ipywidgets import GridspecLayout
 from IPython.display import display
 from IPython.display import clear_output
 
@@ -61,97 +66,29 @@ def load_regions():
 
 def get_access_token(url):
     
-    if url is None:
-        url = 'https://iam.extreme-datacloud.eu/token'
-    
-    #TODO manage exceptions
-    access_token = os.environ['OAUTH2_AUTHORIZE_TOKEN']
-    refresh_token = os.environ['OAUTH2_REFRESH_TOKEN']
-
-    IAM_CLIENT_ID = os.environ['IAM_CLIENT_ID']
-    IAM_CLIENT_SECRET = os.environ['IAM_CLIENT_SECRET']
-
-    data = {'refresh_token': refresh_token, 
-            'grant_type': 'refresh_token', 
-            'client_id':IAM_CLIENT_ID, 
-            'client_secret':IAM_CLIENT_SECRET}
-    
-    headers = {'Content-Type': 'application/json'}
-    url = url + "?grant_type=refresh_token&refresh_token="
-    url = url + refresh_token + '&client_id='
-    url = url + IAM_CLIENT_ID + '&client_secret=' + IAM_CLIENT_SECRET
-    url = url + "&scope=openid email profile offline_access fts:submit-transfer"
-
-    r = requests.post(url, headers=headers) #GET token
-    print("Requesting access token: %s" % r.status_code) #200 means that the resource exists
-    access_token = json.loads(r.content)['access_token']
+    if url is not None and url != orchestrator.client().iam_url:
+        orchestrator.client().iam_url = url
     
-    return access_token
+    #cached until it is about to expire
+    return orchestrator.client().access_token()
 
 
 def launch_orchestrator_sat_job(sat_args):
 
-    access_token = get_access_token('https://iam.extreme-datacloud.eu/token')
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer '+access_token}
-    tosca_file = '.SAT_DATA_D.yml'
-
-    with open(tosca_file, 'r') as myfile:
-        tosca = myfile.read()
-    
-    sat = json.dumps(sat_args)
-    sat = sat.replace(" ", "")
-    
-    data = {"parameters" : {
-                "cpus" : 1,
-                "mem" : "8192 MB",
-                "onedata_provider" : "vm027.pub.cloud.ifca.es",
-                "onedata_zone" : "https://onezone.cloud.cnaf.infn.it",
-                "onedata_sat_space" : "XDC_LifeWatch",
-                "onedata_mount_point": "/mnt/onedata",
-                "sat_args" : sat,
-                "region" : sat_args['region'],
-                "start_date" : sat_args['start_date'],
-                "end_date" : sat_args['end_date']
-                 },
-            "template" : tosca
-            }
-    print ('search parameters: {}'.format(data))
-
-    url = 'https://xdc-paas.cloud.ba.infn.it/orchestrator/deployments/'
-    r = requests.post(url, headers=headers,data=json.dumps(data)) #GET
-    print("Status code SAT: %s" % r.status_code) #200 means that the resource exists
-    print(r.headers)
-    txt = json.loads(r.text)
-    print (json.dumps(txt, indent=2, sort_keys=True))
-    deployment_id = json.loads(r.content)['uuid']
-    print("Deployment ID: %s" % deployment_id)
-    return deployment_id
+    return orchestrator.client().launch(sat_args)
     
 def orchestrator_job_status(deployment_id):
-    #TODO manage exceptions
-    access_token = get_access_token('https://iam.extreme-datacloud.eu/token')
-    url =  'https://xdc-paas.cloud.ba.infn.it/orchestrator/deployments/'+deployment_id
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer '+access_token}
-    r = requests.get(url, headers=headers) #GET token
-    print("Status code: %s" % r.status_code)
-    txt = json.loads(r.text)
+    
+    txt = orchestrator.client().job_status(deployment_id)
     print (json.dumps(txt, indent=2, sort_keys=True))
-    #print(r.text)
-    #print(r.reason)
-    return r.content
+    return txt
 
 def orchestrator_list_deployments(orchestrator_url):
     
-    #TODO manage exceptions
-    access_token = get_access_token('https://iam.extreme-datacloud.eu/token')
+    if orchestrator_url is not None:
+        orchestrator.client().orchestrator_url = orchestrator_url
     
-    if orchestrator_url is None:
-        orchestrator_url = 'https://xdc-paas.cloud.ba.infn.it/orchestrator/'
-    
-    url = orchestrator_url + 'deployments'
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer '+access_token}
-    r = requests.get(url, headers=headers) #GET
-    return json.loads(r.content)['content']
+    return orchestrator.client().list_deployments()
 
 ############################## MENU ##################################
 
@@ -197,23 +134,87 @@ box2 = HBox(children=[name, cloud])
 grid = GridspecLayout(3, 3)
 grid[0, :], grid[1, :], grid[2,1] = box, box2, namebutton
 
-ingestion = VBox(children=[grid, out])
+#Batch mode: several regions and a long date range split in chunks
+batch_regions = widgets.SelectMultiple(
+    options=list(load_regions().keys()),
+    description='Regions:',
+    disabled=False)
+
+chunk_days = widgets.BoundedIntText(
+    value=30, min=1, max=366,
+    description='Days per job:',
+    disabled=False)
+
+concurrency = widgets.BoundedIntText(
+    value=4, min=1, max=32,
+    description='Concurrency:',
+    disabled=False)
+
+batchbutton = widgets.Button(description='Run batch')
 
-#Map to select the coordinates
-m = Map(center=(41.975381, 358.489681), basemap=basemaps.Esri.WorldStreetMap, zoom=5)
-draw_control = DrawControl(rectangle = {"shapeOptions": {"fillColor": "#fca45d",
-                                                        "color": "#fca45d",
-                                                        "fillOpacity": 0.7}})
+batch_progress = VBox()
 
-draw_control.clear_polygons()
-m.add_control(draw_control)
+batch = HBox(children=[batch_regions, VBox(children=[chunk_days, concurrency, batchbutton, batch_progress])])
 
-#To group the widgets
-tab = VBox(children=[ini_date, end_date, satellite, name, cloud, mapbutton])
+ingestion = VBox(children=[grid, batch, out])
 
-#Create grid to fill it in with widgets
-mapgrid = GridspecLayout(2, 2)
-mapgrid[:, 0], mapgrid[:, 1] = m, tab
+#One map for the notebook: coordinates of new regions, clipping shapes and
+#tiles of the plotted layers (see build_map)
+m = None
+mapgrid = None
+
+def build_map():
+    """
+    Map of the notebook, built the first time it is shown and then reused,
+    so the tile overlays always observe the map on screen
+    """
+    
+    global m, draw_control
+    
+    if m is not None:
+        return m
+    
+    from ipyleaflet import Map, basemaps, DrawControl
+    
+    m = Map(center=(41.975381, 358.489681), basemap=basemaps.Esri.WorldStreetMap, zoom=5)
+    draw_control = DrawControl(rectangle = {"shapeOptions": {"fillColor": "#fca45d",
+                                                            "color": "#fca45d",
+                                                            "fillOpacity": 0.7}})
+
+    draw_control.clear_polygons()
+    draw_control.on_draw(draw_on_change)
+    m.add_control(draw_control)
+    
+    return m
+
+def build_mapgrid():
+    """
+    Map to select the coordinates, built the first time it is shown
+    """
+    
+    global mapgrid
+    
+    if mapgrid is not None:
+        return mapgrid
+
+    #To group the widgets
+    tab = VBox(children=[ini_date, end_date, satellite, name, cloud, mapbutton])
+
+    #Create grid to fill it in with widgets
+    mapgrid = GridspecLayout(2, 2)
+    mapgrid[:, 0], mapgrid[:, 1] = build_map(), tab
+    
+    return mapgrid
+
+def draw_on_change(target, action, geo_json):
+    """
+    Clip the plots of the Wq Satellite tab to the last shape drawn
+    """
+    
+    if action == 'created' and geo_json['geometry']['type'] == 'Polygon':
+        paths['polygon'] = geo_index.geojson_polygon(geo_json['geometry'])
+    elif action == 'deleted' and 'coordinates' in paths:
+        paths['polygon'] = geo_index.box_polygon(paths['coordinates'])
 
 def namebutton_clicked(namebutton):
 
@@ -238,8 +239,8 @@ def namebutton_clicked(namebutton):
     
     else:
 
-        ingestion = VBox(children=[mapgrid, out])
-        user_interface.children = [ingestion, status, visualization]
+        ingestion = VBox(children=[build_mapgrid(), out])
+        user_interface.children = [ingestion] + list(user_interface.children[1:])
 
 namebutton.on_click(namebutton_clicked)
 
@@ -261,35 +262,117 @@ def mapbutton_clicked(mapbutton):
     
 mapbutton.on_click(mapbutton_clicked)
 
+def batchbutton_clicked(batchbutton):
+    
+    regions = load_regions()
+    selected = {r: regions[r] for r in batch_regions.value}
+    
+    jobs = orchestrator.batch_sat_args(selected, ini_date.value, end_date.value,
+                                       days=chunk_days.value, cloud=cloud.value,
+                                       sat_type=satellite.value)
+    
+    bar = widgets.IntProgress(value=0, min=0, max=len(jobs), description='Submitted:')
+    failures = widgets.Label()
+    batch_progress.children = [bar, failures]
+    
+    lock = threading.Lock()
+    
+    #Called from the submission threads
+    def progress(sat_args, deployment_id, error):
+        with lock:
+            bar.value += 1
+        if error is not None:
+            failures.value = 'Failed: {} {}-{}: {}'.format(sat_args['region'], sat_args['start_date'],
+                                                         sat_args['end_date'], error)
+    
+    def load(token):
+        return orchestrator.client().launch_batch(jobs, concurrency=concurrency.value, progress=progress)
+    
+    def done(ids):
+        batchbutton.disabled = False
+        with out:
+            clear_output()
+            for sat_args, deployment_id in zip(jobs, ids):
+                print('{} {} - {}: {}'.format(sat_args['region'], sat_args['start_date'],
+                                              sat_args['end_date'], deployment_id))
+    
+    def failed(exc):
+        batchbutton.disabled = False
+        with out:
+            clear_output()
+            print('Error: {}'.format(exc))
+    
+    def started():
+        batchbutton.disabled = True
+        with out:
+            clear_output()
+            print('Submitting {} jobs ...'.format(len(jobs)))
+    
+    #Submissions run in the background, the notebook stays responsive
+    async_tasks.background.submit('batch', load, done, started, failed)
+    
+batchbutton.on_click(batchbutton_clicked)
+
 ######################################
 ##############  Jobs  ################
 ######################################
 
-job_list=[]
-for e in orchestrator_list_deployments(None):
-    job_list.append('ID: ' + e['uuid'] + ' | Creation time: ' + e['creationTime'] + ' | Status: ' + e['status'])
+def build_jobs_tab():
+    """
+    Job list, built (and polled) once the tab is opened
+    """
+    
+    global selection_jobs, jobs, status
+    
+    selection_jobs = widgets.Select(
+        options=[],
+        value=None,
+        # rows=10,
+        description='Job List',
+        disabled=False,
+        layout=Layout(width='90%'))
 
-selection_jobs = widgets.Select(
-    options=job_list,
-    value=None,
-    # rows=10,
-    description='Job List',
-    disabled=False,
-    layout=Layout(width='90%'))
+    button2 = widgets.Button(
+        description='Show deployment',)
 
-button2 = widgets.Button(
-    description='Show deployment',)
+    more_button = widgets.Button(
+        description='Older jobs',)
 
-out2 = widgets.Output()
+    out2 = widgets.Output()
 
-@button2.on_click
-def model_on_click(b):
-    with out2:
-        clear_output()
-        jb = selection_jobs.value
-        orchestrator_job_status(jb[jb.find('ID: ', 0)+len('ID: '):jb.find(' | ')])
+    def jobs_changed(monitor):
+        
+        options = monitor.options()
+        if list(selection_jobs.options) != options:
+            value = selection_jobs.value
+            selection_jobs.options = options
+            if value in monitor.jobs:
+                selection_jobs.value = value
+        more_button.disabled = not monitor.has_more
+
+    #Deployments are fetched and polled in the background
+    jobs = job_monitor.JobMonitor(on_change=jobs_changed)
+    jobs.start()
+
+    @button2.on_click
+    def model_on_click(b):
+        with out2:
+            clear_output()
+            if selection_jobs.value is not None:
+                orchestrator_job_status(selection_jobs.value)
 
-status = VBox(children=[selection_jobs, button2, out2])
+    @more_button.on_click
+    def more_on_click(b):
+        with out2:
+            clear_output()
+            jobs.load_more()
+
+    status = VBox(children=[selection_jobs, HBox([button2, more_button]), out2])
+    
+    return status
+
+#Placeholder until the tab is opened
+status = VBox()
 
 ######################################
 #######  Data Visualization  #########
@@ -302,53 +385,46 @@ path = '/home/jovyan/datasets/XDC_LifeWatch'
         
 paths = {'main_path': path}
 
+#Spans of the plotting callbacks, shown in the diagnostics panel
+recorder = None
+
+#Tiles of the last plotted layer on the map (see map_tiles.py)
+tile_overlay = None
+
 ##################################### Plot Functions #########################################
 
-def band_on_change(v):
+def show_progress(message):
+    
+    with out_plot:
+        clear_output()
+        print(message)
 
-    dataset= Dataset(paths['file_path'], 'r', format='NETCDF4_CLASSIC')
-    band = bands_desc[v['new']]
-    data = dataset[band][:]
-    vmin, vmax, mean, std = np.amin(data), np.amax(data), np.mean(data), np.std(data)
-    stats = "min = {}, Max = {}".format(vmin, vmax)
-    stats2 = "mean = {}, std = {}".format(mean, std)
+def show_error(exc):
     
     with out_plot:
-        
         clear_output()
-        
-        plt.figure(figsize=(7,7))
-        
-        # Plot the image
-        plt.imshow(data, vmin=vmin, vmax=vmax, cmap='Greys')
+        print('Error: {}'.format(exc))
 
-        # Add a colorbar
-        plt.colorbar(label='Brightness', extend='both', orientation='vertical', pad=0.05, fraction=0.05)
+def show_diagnostics(action=None):
+    """
+    Timings of the load and render of a user action in the diagnostics panel
+    """
+    
+    with out_diag:
+        clear_output()
+        print(recorder.summary(spans=2, action=action))
 
-        # Title axis
-        plt.xlabel('Longitude')
-        plt.ylabel('Latitude')
-        plt.tick_params(axis='both', which='both', bottom=False, top=False, right=False, left=False, labelbottom=False, labelleft=False)
+def plot_raster(title, data, st, action=None):
+    
+    with instrumentation.span('plot_raster', title=title, action=action):
+        _plot_raster(title, data, st)
+    show_diagnostics(action)
 
-        # Add a title
-        plt.title('{}'.format(v['new']), fontweight='bold', fontsize=10, loc='left')
-        plt.suptitle(stats, x=0.90, y=0.90, fontsize='large')
-        plt.suptitle(stats2, x=0.95, y=0.95, fontsize='large')
-        
-        # Show the image
-        plt.show()        
-        
-def index_on_change(v):
+def _plot_raster(title, data, st):
     
-    band_dict = utils_plot.load_bands(paths['file_path'], bands_desc)
-   
-    if file.startswith('LC'):    
-        arr_index = utils_plot.landsat_wq(band_dict, v['new'])
+    import matplotlib.pyplot as plt
     
-    elif file.startswith('S2'):
-        arr_index = utils_plot.sentinel_wq(band_dict, v['new'])
-        
-    vmin, vmax, mean, std = np.amin(arr_index), np.amax(arr_index), np.mean(arr_index), np.std(arr_index)
+    vmin, vmax, mean, std = st['min'], st['max'], st['mean'], st['std']
     stats = "min = {}, Max = {}".format(vmin, vmax)
     stats2 = "mean = {}, std = {}".format(mean, std)
     
@@ -359,7 +435,7 @@ def index_on_change(v):
         plt.figure(figsize=(7,7))
         
         # Plot the image
-        plt.imshow(arr_index, vmin=vmin, vmax=vmax, cmap='Greys')
+        plt.imshow(data, vmin=vmin, vmax=vmax, cmap='Greys')
 
         # Add a colorbar
         plt.colorbar(label='Brightness', extend='both', orientation='vertical', pad=0.05, fraction=0.05)
@@ -370,58 +446,144 @@ def index_on_change(v):
         plt.tick_params(axis='both', which='both', bottom=False, top=False, right=False, left=False, labelbottom=False, labelleft=False)
 
         # Add a title
-        plt.title('{}'.format(v['new']), fontweight='bold', fontsize=10, loc='left')
+        plt.title('{}'.format(title), fontweight='bold', fontsize=10, loc='left')
         plt.suptitle(stats, x=0.90, y=0.90, fontsize='large')
         plt.suptitle(stats2, x=0.95, y=0.95, fontsize='large')
         
         # Show the image
         plt.show()
+
+def tile_source(file_path, kind, layer, limits):
+    """
+    Tiles of a plotted layer (see map_tiles.py) with the limits of its plot,
+    None if the scene has no lat/lon grid; built in the load of the plot
+    """
+    
+    try:
+        return map_tiles.TileSource(file_path, kind, layer, limits=limits)
+    except ValueError:
+        return None
+
+def show_map_layer():
+    """
+    Draw the last plotted layer (paths['layer']) as tiles on the map, when
+    the map is shown
+    """
+    
+    global tile_overlay
+    
+    fit = tile_overlay is None
+    if tile_overlay is not None:
+        tile_overlay.remove()
+        tile_overlay = None
+    
+    source = paths.get('layer')
+    if not map_toggle.value or source is None:
+        return
+    
+    if fit:
+        m.fit_bounds(source.bounds)
+    tile_overlay = map_tiles.TileOverlay(m, source)
+
+def map_on_change(v):
+    
+    if v['new']:
+        map_box.children = [build_map()]
+    else:
+        map_box.children = []
+    
+    show_map_layer()
+
+def band_on_change(v):
     
+    if v['new'] is None:
+        return
+    
+    file_path, band = paths['file_path'], bands_desc[v['new']]
+    
+    polygon = paths['polygon']
+    action = instrumentation.new_action()
+    
+    def load(token):
+        with instrumentation.span('band_on_change', band=band, action=action):
+            window, step = utils_plot.preview_read(file_path, polygon=polygon)
+            token.check()
+            data = band_store.store.get(file_path, band, window, step)
+            data = geo_index.clip(data, file_path, polygon, window, step)
+            token.check()
+            with instrumentation.span('stats'):
+                st = wq_stats.cached_stats(file_path, (band, geo_index.polygon_key(polygon)), data, window, step)
+            token.check()
+            source = tile_source(file_path, 'band', band, utils_plot.stretch_limits([data], stats=[st]))
+        return data, st, source
+    
+    def render(r):
+        data, st, source = r
+        plot_raster(v['new'], data, st, action=action)
+        paths['layer'] = source
+        show_map_layer()
+    
+    async_tasks.runner.submit('plot', load, render,
+                              lambda: show_progress('Loading {} ...'.format(v['new'])), show_error)
+        
+def index_on_change(v):
     
+    if v['new'] is None:
+        return
+    
+    file_path, index = paths['file_path'], v['new']
+    
+    polygon = paths['polygon']
+    action = instrumentation.new_action()
+    
+    def load(token):
+        with instrumentation.span('index_on_change', index=index, action=action):
+            window, step = utils_plot.preview_read(file_path, polygon=polygon)
+            token.check()
+            # only the region box goes to the disk cache, drawn shapes stay in memory
+            region_box = 'coordinates' in paths and polygon == geo_index.box_polygon(paths['coordinates'])
+            arr_index = product_cache.cached_index(file_path, index, window=window, step=step,
+                                                   persist=region_box)
+            arr_index = geo_index.clip(arr_index, file_path, polygon, window, step)
+            token.check()
+            with instrumentation.span('stats'):
+                st = wq_stats.cached_stats(file_path, (index, geo_index.polygon_key(polygon)), arr_index,
+                                           window, step)
+            token.check()
+            source = tile_source(file_path, 'index', index, [(st['min'], st['max'])])
+        return arr_index, st, source
+    
+    def render(r):
+        arr_index, st, source = r
+        plot_raster(index, arr_index, st, action=action)
+        paths['layer'] = source
+        show_map_layer()
+    
+    async_tasks.runner.submit('plot', load, render,
+                              lambda: show_progress('Computing {} ...'.format(index)), show_error)
         
 def date_on_change(v):
     
-    global out_plot, bands_desc, file   
+    global out_plot, out_diag, bands_desc, file, map_toggle, map_box, tile_overlay
     
+    # drop the plots and the local copy still running for the previous date
+    async_tasks.runner.cancel()
+    async_tasks.background.cancel('local')
     clear_output()
     
+    if tile_overlay is not None:
+        tile_overlay.remove()
+        tile_overlay = None
+    paths.pop('layer', None)
+    
     file = str(folders[v['new']])
     file_path = os.path.join(paths['region_path'], file)
     paths['file_path'] = file_path
     
-    if file.startswith('LC'):
-                
-        bands_desc = {'B1 [435nm-451nm]':'SRB1',
-                     'B2 Blue [452nm-512nm]':'SRB2',
-                     'B3 Green [533nm-590nm]':'SRB3',
-                     'B4 Red [636nm-673nm]':'SRB4',
-                     'B5 [851nm-879nm]':'SRB5',
-                     'B6 [1566nm-1651nm]':'SRB6',
-                     'B7 [2107nm-2294nm]':'SRB7',
-                     'B8 [503nm-676nm]':'B8',
-                     'B9 [1363nm-1384nm]':'SRB9',
-                     'B10 [1060nm-1119nm]':'SRB10',
-                     'B11 [1150nm-1251nm]':'SRB11'}
-        
-        index_list = ['chl', 'Turb', 'Temp']
-        
-    elif file.startswith('S2'):
-        
-        bands_desc = {'B1 [443 nm]':'SRB1',
-                     'B2 Blue [490 nm]':'B2',
-                     'B3 Green [560 nm]':'B3',
-                     'B4 Red [665 nm]':'B4',
-                     'B5 [705 nm]':'SRB5',
-                     'B6 [740 nm]':'SRB6',
-                     'B7 [783 nm]':'SRB7',
-                     'B8 [842 nm]':'B8',
-                     'B8A [865 nm]':'SRB8A',
-                     'B9 [945 nm]':'SRB9',
-                     'B10 [1375 nm]':'SRB10',
-                     'B11 [1610 nm]':'SRB11',
-                     'B12 [2190 nm]':'SRB12'}
-        
-        index_list = ['chl', 'Turb']
+    # band labels and indices of the sensor, from the index registry
+    sensor = utils_plot.scene_sensor(file)
+    bands_desc = wq_indices.band_labels[sensor]
+    index_list = wq_indices.available(sensor)
     
     bands = list(bands_desc.keys())
     
@@ -449,18 +611,12 @@ def date_on_change(v):
     
     RGB_button = widgets.Button(description='RGB Plot',)
     
-    @RGB_button.on_click
-    def RGB_on_click(b):
-        with out_plot:
+    def plot_rgb(RGB_image, action=None):
+        import matplotlib.pyplot as plt
+        
+        with instrumentation.span('plot_rgb', action=action), out_plot:
             clear_output()
             
-            dataset= Dataset(paths['file_path'], 'r', format='NETCDF4_CLASSIC')            
-            arr_R = dataset[bands_desc[R.value]][:]            
-            arr_G = dataset[bands_desc[G.value]][:]            
-            arr_B = dataset[bands_desc[B.value]][:]
-            
-            RGB_image = utils_plot.color_composite(arr_R, arr_G, arr_B)
-            
             # Plot the image
             plt.figure(figsize=(7,7))
             plt.imshow(RGB_image)
@@ -472,6 +628,43 @@ def date_on_change(v):
 
             # Show the image
             plt.show()
+        show_diagnostics(action)
+    
+    @RGB_button.on_click
+    def RGB_on_click(b):
+        
+        file_path = paths['file_path']
+        rgb_bands = [bands_desc[c.value] for c in (R, G, B)]
+        
+        polygon = paths['polygon']
+        action = instrumentation.new_action()
+        
+        def load(token):
+            with instrumentation.span('RGB_on_click', bands=rgb_bands, action=action):
+                window, step = utils_plot.preview_read(file_path, polygon=polygon)
+                arrs, stats = [], []
+                for band in rgb_bands:
+                    token.check()
+                    arr = band_store.store.get(file_path, band, window, step)
+                    arr = geo_index.clip(arr, file_path, polygon, window, step)
+                    arrs.append(arr)
+                    with instrumentation.span('stats'):
+                        stats.append(wq_stats.cached_stats(file_path, (band, geo_index.polygon_key(polygon)),
+                                                           arr, window, step))
+                token.check()
+                limits = utils_plot.stretch_limits(arrs, stats=stats)
+                RGB_image = utils_plot.color_composite(*arrs, limits=limits)
+                token.check()
+                return RGB_image, tile_source(file_path, 'rgb', rgb_bands, limits)
+        
+        def render(r):
+            RGB_image, source = r
+            plot_rgb(RGB_image, action)
+            paths['layer'] = source
+            show_map_layer()
+        
+        async_tasks.runner.submit('plot', load, render,
+                                  lambda: show_progress('Loading RGB composite ...'), show_error)
             
         
     index = widgets.ToggleButtons(options=index_list,
@@ -483,6 +676,12 @@ def date_on_change(v):
         
     out_plot = widgets.Output()
     
+    #Timings of the last plot (see instrumentation.py)
+    out_diag = widgets.Output()
+    diagnostics = widgets.Accordion(children=[out_diag])
+    diagnostics.set_title(0, 'Diagnostics')
+    diagnostics.selected_index = None
+    
     RGBbox = VBox([R, G, B, RGB_button])
     
     #Create grid to fill it in with widgets
@@ -493,8 +692,38 @@ def date_on_change(v):
     main_grid = GridspecLayout(2, 1)
     main_grid[0, 0], main_grid[1, 0] = select_grid, out_plot
    
-    top_box = HBox([region, date])
-    main_box = VBox([top_box, main_grid])
+    #Local memory-mapped copy of the scene (see local_scenes.py)
+    local_button = widgets.Button(description='Local copy',
+                                  disabled=local_scenes.metadata(paths['file_path']) is not None)
+    
+    @local_button.on_click
+    def local_on_click(b):
+        
+        file_path = paths['file_path']
+        local_button.disabled = True
+        
+        def load(token):
+            return local_scenes.convert(file_path, check=token.check)
+        
+        def done(folder):
+            local_button.description = 'Local copy ready'
+            show_progress('Local copy in {}'.format(folder))
+        
+        def failed(exc):
+            local_button.disabled = False
+            show_error(exc)
+        
+        async_tasks.background.submit('local', load, done,
+                                      lambda: show_progress('Copying the scene to {} ...'.format(local_scenes.local_folder)),
+                                      failed)
+    
+    #Tiles of the plotted layer on the ipyleaflet map
+    map_toggle = widgets.ToggleButton(value=False, description='Map view')
+    map_toggle.observe(map_on_change, names='value')
+    map_box = VBox()
+    
+    top_box = HBox([region, date, local_button, map_toggle])
+    main_box = VBox([top_box, map_box, main_grid, diagnostics])
 
     user_interface.children = [ingestion, status, main_box]
     display(user_interface)
@@ -502,43 +731,66 @@ def date_on_change(v):
     
 def region_on_change(v):
     
-    global date, folders
     clear_output()
     
-    region_path = os.path.join(path, v['new'])
+    name = v['new']
+    region_path = os.path.join(path, name)
     paths['region_path'] = region_path
+    paths['coordinates'] = load_regions()[name]['coordinates']
+    paths['polygon'] = geo_index.box_polygon(paths['coordinates'])
+    
+    filters = HBox([region, scene_satellite, scene_cloud])
+    message = widgets.Label('Indexing the scenes of {} ...'.format(name))
+    user_interface.children = [ingestion, status, VBox([filters, message])]
+    display(user_interface)
+    
+    satellite_filter, max_cloud = scene_satellite.value, scene_cloud.value
     
-    list_folders = os.listdir(region_path)
+    #The first indexing opens every scene, off the kernel thread
+    def load(token):
+        return scene_catalogue.region_scenes(name, region_path, satellite=satellite_filter,
+                                             max_cloud=max_cloud)
+    
+    def render(scenes):
+        global date, folders
         
-    folders = {}
-    for f in list_folders:
-        if f.startswith('LC'):
-            year = f[9:13]
-            day = f[13:16]
-            date = datetime.datetime.strptime('{} {}'.format(year, day), '%Y %j')
-            date = date.strftime('%d/%m/%Y')
-            folders[date] = f
-        elif f.startswith('S2'):
-            date = datetime.datetime.strptime(f[11:19], '%Y%m%d').strftime('%m/%d/%Y')
-            folders[date] = f
-    
-    list_dates = list(folders.keys())
-    date = widgets.Dropdown(options=[list_dates[n] for n in range(len(list_dates))],
-                            value = None,
-                            description='Dates:',)
-    
-    date.observe(date_on_change, names='value')
+        folders = {}
+        for scene_date, f in scenes:
+            if f.startswith('LC'):
+                folders[scene_date.strftime('%d/%m/%Y')] = f
+            else:
+                folders[scene_date.strftime('%m/%d/%Y')] = f
         
-    hbox = HBox([region, date])
-    user_interface.children = [ingestion, status, hbox]
-    display(user_interface)
+        list_dates = list(folders.keys())
+        date = widgets.Dropdown(options=[list_dates[n] for n in range(len(list_dates))],
+                                value = None,
+                                description='Dates:',)
+        
+        date.observe(date_on_change, names='value')
+            
+        hbox = HBox([region, date, scene_satellite, scene_cloud])
+        user_interface.children = [ingestion, status, hbox]
+    
+    def failed(exc):
+        message.value = 'Error: {}'.format(exc)
+    
+    async_tasks.background.submit('catalogue', load, render, on_error=failed)
+
+def filters_on_change(v):
+    
+    if region.value is not None:
+        region_on_change({'new': region.value})
 
 #####################################################################################
 
 def data_visualization():
     
-    global region
-    clear_output()
+    global region, recorder, scene_satellite, scene_cloud
+    
+    if recorder is None:
+        recorder = instrumentation.Recorder()
+        if instrumentation.log_path is None:
+            instrumentation.log_path = instrumentation.default_log_path
     
     #load the downloaded files
     regions = load_regions()
@@ -551,17 +803,42 @@ def data_visualization():
                               description='Available Regions:',)
 
     region.observe(region_on_change, names='value')
-    vbox = VBox([region]) 
+    
+    #Scene filters, starting from the criteria of the ingestion tab
+    scene_satellite = widgets.Dropdown(options=['Sentinel2', 'Landsat8', 'All'],
+                                       value=satellite.value,
+                                       description='Satellite:',)
+    scene_cloud = widgets.IntSlider(value=cloud.value or 100,
+                                    description='Max cloud',)
+    scene_satellite.observe(filters_on_change, names='value')
+    scene_cloud.observe(filters_on_change, names='value')
+    
+    vbox = VBox([HBox([region, scene_satellite, scene_cloud])]) 
     
     return vbox
 
 
-wq_sat = data_visualization()
-    
 #Menu
 user_interface = widgets.Tab()
-user_interface.children = [ingestion, status, wq_sat]
+user_interface.children = [ingestion, status, VBox()]
 user_interface.set_title(0,'Data Ingestion')
 user_interface.set_title(1,'Job status')
 user_interface.set_title(2, 'Wq Satellite')
+
+def tab_on_change(v):
+    
+    global wq_sat
+    
+    children = list(user_interface.children)
+    if v['new'] == 1 and not children[1].children:
+        children[1] = build_jobs_tab()
+    elif v['new'] == 2 and not children[2].children:
+        wq_sat = data_visualization()
+        children[2] = wq_sat
+    else:
+        return
+    
+    user_interface.children = children
+    
+user_interface.observe(tab_on_change, names='selected_index')
 user_interface